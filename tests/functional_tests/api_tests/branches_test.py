@@ -0,0 +1,518 @@
+"""Tests for the branches API."""
+
+import asyncio
+import os
+import shutil
+import time
+
+from fastapi.testclient import TestClient
+from pygit2 import Commit, Repository, Signature, clone_repository, init_repository
+from pygit2.enums import FileMode
+
+from uedition_editor import cron
+from uedition_editor.api.util import PushQueue, fetch_remote
+from uedition_editor.settings import init_settings
+from uedition_editor.state import branch_status_cache
+
+
+def add_remote(path: str) -> Repository:
+    """Add a bare remote repository at `path` and push the default branch to it."""
+    remote = init_repository(path, bare=True)
+    repo = Repository(init_settings.base_path)
+    repo.remotes.create(init_settings.git.remote_name, remote.path)
+    repo.remotes[init_settings.git.remote_name].push([f"refs/heads/{init_settings.git.default_branch}"])
+    repo.branches[init_settings.git.default_branch].upstream = repo.branches[
+        f"{init_settings.git.remote_name}/{init_settings.git.default_branch}"
+    ]
+    return remote
+
+
+def commit_to_remote(remote: Repository, path: str, branch: str, content: bytes) -> None:
+    """Commit the `content` to the en/index.md file in the `branch` of the `remote` via a clone at `path`."""
+    clone = clone_repository(remote.path, path, checkout_branch=branch)
+    with open(os.path.join(path, "en", "index.md"), "wb") as out_f:
+        out_f.write(content)
+    index = clone.index
+    index.add_all()
+    index.write()
+    signature = Signature("Remote Editor", "remote@example.com")
+    clone.create_commit("HEAD", signature, signature, "Remote edit", index.write_tree(), [clone.head.target])
+    clone.remotes["origin"].push([f"refs/heads/{branch}"])
+
+
+def test_list_branches(git_app: TestClient) -> None:
+    """Test listing the available branches."""
+    response = git_app.get("/api/branches")
+    assert response.status_code == 200
+    assert response.json() == {
+        "local": [
+            {
+                "id": "main",
+                "title": "Main",
+                "nogit": False,
+                "update_from_default": False,
+                "modified_files": [],
+                "pending_push": False,
+                "push_rejected": False,
+            }
+        ],
+        "remote": [],
+        "archived": [],
+    }
+
+
+def test_create_branch(git_app: TestClient) -> None:
+    """Test creating a new branch."""
+    response = git_app.post("/api/branches", json={"title": "New Branch"})
+    assert response.status_code == 200
+    assert response.json()["id"] == "new-branch"
+    response = git_app.get("/api/branches")
+    assert [branch["id"] for branch in response.json()["local"]] == ["main", "new-branch"]
+
+
+def test_edit_branch_in_worktree(git_app: TestClient) -> None:
+    """Test that editing a branch does not touch the default branch's working tree."""
+    git_app.post("/api/branches", json={"title": "Edits"})
+    response = git_app.put("/api/branches/edits/files/en/index.md", files={"content": b"# Edited"})
+    assert response.status_code == 204
+    with open(os.path.join(init_settings.base_path, "en", "index.md")) as in_f:
+        assert in_f.read() != "# Edited"
+    repo = Repository(init_settings.base_path)
+    assert repo.head.shorthand == "main"
+    assert repo.revparse_single("edits:en/index.md").data == b"# Edited"
+    response = git_app.get("/api/branches/edits/files/en/index.md")
+    assert response.status_code == 200
+    assert response.text == "# Edited"
+    git_app.patch("/api/branches")
+    response = git_app.get("/api/branches")
+    branches = {branch["id"]: branch for branch in response.json()["local"]}
+    assert branches["edits"]["modified_files"] == ["en/index.md"]
+
+
+def test_fail_missing_branch(git_app: TestClient) -> None:
+    """Test that accessing a missing branch fails."""
+    response = git_app.get("/api/branches/does-not-exist/files/en/index.md")
+    assert response.status_code == 404
+
+
+def test_merge_into_default(git_app: TestClient) -> None:
+    """Test merging a branch into the default branch."""
+    git_app.post("/api/branches", json={"title": "Edits"})
+    git_app.put("/api/branches/edits/files/en/index.md", files={"content": b"# Edited"})
+    response = git_app.post("/api/branches/edits/merge-into-default")
+    assert response.status_code == 204
+    with open(os.path.join(init_settings.base_path, "en", "index.md")) as in_f:
+        assert in_f.read() == "# Edited"
+    response = git_app.get("/api/branches")
+    assert [branch["id"] for branch in response.json()["local"]] == ["main"]
+
+
+def test_merge_unchanged_into_default(git_app: TestClient) -> None:
+    """Test that merging a branch without changes deletes it without committing to the default branch."""
+    repo = Repository(init_settings.base_path)
+    default_head = repo.head.target
+    git_app.post("/api/branches", json={"title": "Unchanged"})
+    response = git_app.post("/api/branches/unchanged/merge-into-default")
+    assert response.status_code == 204
+    assert repo.head.target == default_head
+    response = git_app.get("/api/branches")
+    assert [branch["id"] for branch in response.json()["local"]] == ["main"]
+
+
+def test_merge_from_default(git_app: TestClient) -> None:
+    """Test merging the default branch into a branch."""
+    git_app.post("/api/branches", json={"title": "First"})
+    git_app.post("/api/branches", json={"title": "Second"})
+    git_app.put("/api/branches/first/files/en/index.md", files={"content": b"# Edited"})
+    git_app.post("/api/branches/first/merge-into-default")
+    response = git_app.get("/api/branches")
+    branches = {branch["id"]: branch for branch in response.json()["local"]}
+    assert branches["second"]["update_from_default"] is True
+    response = git_app.post("/api/branches/second/merge-from-default")
+    assert response.status_code == 204
+    response = git_app.get("/api/branches/second/files/en/index.md")
+    assert response.text == "# Edited"
+    repo = Repository(init_settings.base_path)
+    assert len(repo.branches["second"].peel().parents) == 2
+    assert "second" not in [name.replace("%2F", "/") for name in repo.list_worktrees()]
+
+
+def test_merge_preview(git_app: TestClient) -> None:
+    """Test previewing a merge without conflicts."""
+    git_app.post("/api/branches", json={"title": "Edits"})
+    git_app.put("/api/branches/edits/files/en/index.md", files={"content": b"# Edited"})
+    response = git_app.get("/api/branches/edits/merge-preview")
+    assert response.status_code == 200
+    assert response.json() == {"conflicts": [], "into_default": ["en/index.md"], "from_default": []}
+    assert git_app.get("/api/branches/main/merge-preview").status_code == 422
+    assert git_app.get("/api/branches/missing/merge-preview").status_code == 404
+
+
+def test_merge_conflict(git_app: TestClient) -> None:
+    """Test that conflicting changes are not merged."""
+    git_app.post("/api/branches", json={"title": "First"})
+    git_app.post("/api/branches", json={"title": "Second"})
+    git_app.put("/api/branches/first/files/en/index.md", files={"content": b"# First"})
+    git_app.put("/api/branches/second/files/en/index.md", files={"content": b"# Second"})
+    git_app.post("/api/branches/first/merge-into-default")
+    response = git_app.get("/api/branches/second/merge-preview")
+    assert response.status_code == 200
+    assert response.json() == {
+        "conflicts": ["en/index.md"],
+        "into_default": ["en/index.md"],
+        "from_default": ["en/index.md"],
+    }
+    repo = Repository(init_settings.base_path)
+    second_commit = repo.branches["second"].target
+    response = git_app.post("/api/branches/second/merge-from-default")
+    assert response.status_code == 409
+    assert repo.branches["second"].target == second_commit
+    response = git_app.post("/api/branches/second/merge-into-default")
+    assert response.status_code == 409
+    with open(os.path.join(init_settings.base_path, "en", "index.md")) as in_f:
+        assert in_f.read() == "# First"
+
+
+def test_delete_branch(git_app: TestClient) -> None:
+    """Test deleting a branch."""
+    git_app.post("/api/branches", json={"title": "Edits"})
+    git_app.get("/api/branches/edits/files/en/index.md")
+    response = git_app.delete("/api/branches/edits")
+    assert response.status_code == 204
+    response = git_app.get("/api/branches")
+    assert [branch["id"] for branch in response.json()["local"]] == ["main"]
+
+
+def test_branch_status_cache(git_app: TestClient) -> None:
+    """Test that the branch status is only recomputed when the branch changes."""
+    git_app.post("/api/branches", json={"title": "Edits"})
+    main_status = branch_status_cache["main"][1]
+    edits_status = branch_status_cache["edits"][1]
+    git_app.put("/api/branches/edits/files/en/index.md", files={"content": b"# Edited"})
+    git_app.patch("/api/branches")
+    assert branch_status_cache["main"][1] is main_status
+    assert branch_status_cache["edits"][1] is not edits_status
+    assert branch_status_cache["edits"][1]["modified_files"] == ["en/index.md"]
+    git_app.delete("/api/branches/edits")
+    assert "edits" not in branch_status_cache
+
+
+def test_pull_from_remote(git_app: TestClient, tmp_path) -> None:
+    """Test that remote changes are fast-forwarded into the checked out and not checked out branches."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    git_app.post("/api/branches", json={"title": "Edits"})
+    commit_to_remote(remote, str(tmp_path / "main-clone"), "main", b"# Remote main")
+    commit_to_remote(remote, str(tmp_path / "edits-clone"), "edits", b"# Remote edits")
+    git_app.patch("/api/branches")
+    with open(os.path.join(init_settings.base_path, "en", "index.md")) as in_f:
+        assert in_f.read() == "# Remote main"
+    repo = Repository(init_settings.base_path)
+    assert repo.list_worktrees() == []
+    assert repo.revparse_single("edits:en/index.md").data == b"# Remote edits"
+    response = git_app.get("/api/branches/edits/files/en/index.md")
+    assert response.text == "# Remote edits"
+
+
+def test_queued_push(git_app: TestClient, tmp_path) -> None:
+    """Test that saving queues the push, which is then pushed in the background."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    git_app.post("/api/branches", json={"title": "Queued"})
+    with git_app:
+        response = git_app.put("/api/branches/queued/files/en/index.md", files={"content": b"# Queued"})
+        assert response.status_code == 204
+        for _ in range(50):
+            branches = {branch["id"]: branch for branch in git_app.get("/api/branches").json()["local"]}
+            if not branches["queued"]["pending_push"]:
+                break
+            time.sleep(0.1)
+        assert remote.revparse_single("queued:en/index.md").data == b"# Queued"
+
+
+def test_queued_push_retry(git_app: TestClient, tmp_path) -> None:
+    """Test that a failed push stays pending for a retry."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    git_app.post("/api/branches", json={"title": "Retry"})
+    shutil.rmtree(remote.path)
+    with git_app:
+        response = git_app.put("/api/branches/retry/files/en/index.md", files={"content": b"# Retry"})
+        assert response.status_code == 204
+        time.sleep(0.5)
+        branches = {branch["id"]: branch for branch in git_app.get("/api/branches").json()["local"]}
+        assert branches["retry"]["pending_push"]
+
+
+def commit_to_branch(branch: str, filename: str, content: bytes) -> None:
+    """Commit the `content` to the en/`filename` file in the local `branch` without pushing it."""
+    repo = Repository(init_settings.base_path)
+    head = repo.branches.local[branch].peel(Commit)
+    en_builder = repo.TreeBuilder(head.tree["en"])
+    en_builder.insert(filename, repo.create_blob(content), FileMode.BLOB)
+    builder = repo.TreeBuilder(head.tree)
+    builder.insert("en", en_builder.write(), FileMode.TREE)
+    signature = Signature("Local Editor", "local@example.com")
+    repo.create_commit(f"refs/heads/{branch}", signature, signature, "Local edit", builder.write(), [head.id])
+
+
+def push_with_queue(branch: str) -> PushQueue:
+    """Push the `branch` via a running push queue, returning the queue once the push has been handled."""
+
+    async def run() -> PushQueue:
+        queue = PushQueue()
+        queue.start()
+        queue.enqueue(branch)
+        for _ in range(50):
+            await asyncio.sleep(0.1)
+            if not queue.is_pending(branch):
+                break
+        await queue.stop()
+        return queue
+
+    return asyncio.run(run())
+
+
+def test_queued_push_diverged(git_app: TestClient, tmp_path) -> None:
+    """Test that a push rejected by a diverged remote is merged with the remote changes and pushed again."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    git_app.post("/api/branches", json={"title": "Diverged"})
+    commit_to_remote(remote, str(tmp_path / "diverged-clone"), "diverged", b"# Remote edit")
+    commit_to_branch("diverged", "local.md", b"# Local edit")
+    queue = push_with_queue("diverged")
+    assert not queue.is_rejected("diverged")
+    head = remote.revparse_single("diverged")
+    assert len(head.parents) == 2
+    assert remote.revparse_single("diverged:en/index.md").data == b"# Remote edit"
+    assert remote.revparse_single("diverged:en/local.md").data == b"# Local edit"
+    response = git_app.get("/api/branches/diverged/files/en/index.md")
+    assert response.text == "# Remote edit"
+
+
+def test_queued_push_conflict(git_app: TestClient, tmp_path) -> None:
+    """Test that a push rejected by a conflicting remote is marked as rejected instead of being retried."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    git_app.post("/api/branches", json={"title": "Conflict"})
+    commit_to_remote(remote, str(tmp_path / "conflict-clone"), "conflict", b"# Remote edit")
+    commit_to_branch("conflict", "index.md", b"# Local edit")
+    queue = push_with_queue("conflict")
+    assert queue.is_rejected("conflict")
+    assert not queue.is_pending("conflict")
+    assert remote.revparse_single("conflict:en/index.md").data == b"# Remote edit"
+
+
+def test_commit_window(git_app: TestClient, tmp_path) -> None:
+    """Test that saves within the commit window are combined into a single commit."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    git_app.post("/api/branches", json={"title": "Window"})
+    repo = Repository(init_settings.base_path)
+    base_commit = repo.branches["window"].target
+    init_settings.git.commit_window = 1
+    try:
+        with git_app:
+            git_app.put("/api/branches/window/files/en/index.md", files={"content": b"# First"})
+            git_app.put("/api/branches/window/files/en/index.md", files={"content": b"# Second"})
+            commit = repo.branches["window"].peel()
+            assert commit.parent_ids == [base_commit]
+            assert commit.message == "Updated en/index.md"
+            assert commit.tree["en/index.md"].data == b"# Second"
+            time.sleep(1.5)
+            assert remote.revparse_single("window").id == commit.id
+    finally:
+        init_settings.git.commit_window = 0
+
+
+def test_commit_window_without_remote(git_app: TestClient) -> None:
+    """Test that saves within the commit window are combined without a remote, keeping the branch's start commit."""
+    git_app.post("/api/branches", json={"title": "Window"})
+    repo = Repository(init_settings.base_path)
+    base_commit = repo.branches["window"].target
+    init_settings.git.commit_window = 60
+    try:
+        git_app.put("/api/branches/window/files/en/index.md", files={"content": b"# First"})
+        git_app.put("/api/branches/window/files/en/index.md", files={"content": b"# Second"})
+        commit = repo.branches["window"].peel()
+        assert commit.parent_ids == [base_commit]
+        assert commit.tree["en/index.md"].data == b"# Second"
+    finally:
+        init_settings.git.commit_window = 0
+
+
+def test_sync_freshness(git_app: TestClient) -> None:
+    """Test that synchronisations within the freshness window keep the current branch state."""
+    repo = Repository(init_settings.base_path)
+    repo.branches.local.create("outside", repo.head.peel())
+    init_settings.git.sync_freshness = 60
+    try:
+        git_app.patch("/api/branches")
+        assert [branch["id"] for branch in git_app.get("/api/branches").json()["local"]] == ["main"]
+    finally:
+        init_settings.git.sync_freshness = 0
+    git_app.patch("/api/branches")
+    assert [branch["id"] for branch in git_app.get("/api/branches").json()["local"]] == ["main", "outside"]
+
+
+def test_sync_single_flight(monkeypatch) -> None:
+    """Test that concurrent synchronisations join the running synchronisation."""
+    calls = []
+
+    async def track_branches() -> bool:
+        calls.append(1)
+        await asyncio.sleep(0.01)
+
+    async def run() -> None:
+        await asyncio.gather(*[cron.synchronise_branches() for _ in range(5)])
+
+    monkeypatch.setattr(cron, "track_branches", track_branches)
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_fetch_max_age(git_app: TestClient, tmp_path) -> None:  # noqa: ARG001
+    """Test that fetches are skipped while the last fetch is fresh enough."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    repo = Repository(init_settings.base_path)
+    assert asyncio.run(fetch_remote(repo)) is True
+    commit_to_remote(remote, str(tmp_path / "clone"), "main", b"# Remote")
+    assert asyncio.run(fetch_remote(repo, max_age=60)) is False
+    assert repo.branches["origin/main"].target != remote.branches["main"].target
+    assert asyncio.run(fetch_remote(repo)) is True
+    assert repo.branches["origin/main"].target == remote.branches["main"].target
+
+
+def test_fetch_tracked(git_app: TestClient, tmp_path) -> None:
+    """Test that only the tracked branches are fetched, while all remote branches are listed."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    remote.branches.local.create("other", remote.branches["main"].peel())
+    commit_to_remote(remote, str(tmp_path / "clone"), "main", b"# Remote")
+    init_settings.git.fetch_mode = "tracked"
+    try:
+        git_app.patch("/api/branches")
+        repo = Repository(init_settings.base_path)
+        assert "origin/other" not in repo.branches.remote
+        assert repo.branches["main"].target == remote.branches["main"].target
+        response = git_app.get("/api/branches")
+        assert [branch["id"] for branch in response.json()["remote"]] == ["origin/main", "origin/other"]
+        response = git_app.post("/api/branches", json={"title": "other"}, headers={"X-Ueditor-Import-Branch": "true"})
+        assert response.status_code == 200
+        assert repo.branches["other"].upstream.branch_name == "origin/other"
+    finally:
+        init_settings.git.fetch_mode = "all"
+
+
+def test_fetch_tracked_create_delete(git_app: TestClient, tmp_path) -> None:
+    """Test that the listed remote branches follow branches created and deleted in the tracked fetch mode."""
+    add_remote(str(tmp_path / "remote.git"))
+    init_settings.git.fetch_mode = "tracked"
+    try:
+        git_app.patch("/api/branches")
+        response = git_app.post("/api/branches", json={"title": "Tracked"})
+        assert response.status_code == 200
+        repo = Repository(init_settings.base_path)
+        assert repo.branches["tracked"].upstream.branch_name == "origin/tracked"
+        git_app.delete("/api/branches/tracked", headers={"X-uEditor-Delete-Local-Only": "true"})
+        response = git_app.get("/api/branches")
+        assert [branch["id"] for branch in response.json()["remote"]] == ["origin/main", "origin/tracked"]
+        git_app.post("/api/branches", json={"title": "tracked"}, headers={"X-Ueditor-Import-Branch": "true"})
+        git_app.delete("/api/branches/tracked")
+        response = git_app.get("/api/branches")
+        assert [branch["id"] for branch in response.json()["remote"]] == ["origin/main"]
+    finally:
+        init_settings.git.fetch_mode = "all"
+
+
+def test_archive_branches(git_app: TestClient) -> None:
+    """Test that merged and stale branches are archived and can be restored."""
+    git_app.post("/api/branches", json={"title": "Merged"})
+    git_app.post("/api/branches", json={"title": "Active"})
+    git_app.post("/api/branches", json={"title": "Fresh"})
+    git_app.put("/api/branches/merged/files/en/index.md", files={"content": b"# Merged"})
+    git_app.put("/api/branches/active/files/en/index.md", files={"content": b"# Active"})
+    repo = Repository(init_settings.base_path)
+    merged_commit = repo.branches["merged"].peel()
+    signature = Signature("A.N. Editor", "editor@example.com")
+    repo.create_commit(
+        "refs/heads/main", signature, signature, "Merged", merged_commit.tree_id, [repo.branches["main"].target]
+    )
+    init_settings.git.archive_merged = True
+    try:
+        asyncio.run(cron.run_maintenance())
+    finally:
+        init_settings.git.archive_merged = False
+    response = git_app.get("/api/branches")
+    assert [branch["id"] for branch in response.json()["local"]] == ["active", "fresh", "main"]
+    assert [branch["id"] for branch in response.json()["archived"]] == ["merged"]
+    assert "merged" not in repo.branches.local
+    response = git_app.post("/api/branches/merged/restore")
+    assert response.status_code == 200
+    assert repo.branches["merged"].target == merged_commit.id
+    response = git_app.get("/api/branches")
+    assert response.json()["archived"] == []
+    assert git_app.post("/api/branches/merged/restore").status_code == 422
+    assert git_app.post("/api/branches/missing/restore").status_code == 404
+
+
+def test_archive_stale_branches(git_app: TestClient) -> None:
+    """Test that branches are stale based on their last activity, not on the age of their last commit."""
+    repo = Repository(init_settings.base_path)
+    signature = Signature("A.N. Editor", "editor@example.com", int(time.time()) - 10 * 86400)
+    head = repo.branches["main"].peel()
+    repo.create_commit("refs/heads/main", signature, signature, "Old", head.tree_id, [head.id])
+    git_app.post("/api/branches", json={"title": "Fresh"})
+    init_settings.git.archive_after_days = 1
+    try:
+        asyncio.run(cron.run_maintenance())
+    finally:
+        init_settings.git.archive_after_days = None
+    response = git_app.get("/api/branches")
+    assert [branch["id"] for branch in response.json()["local"]] == ["fresh", "main"]
+    assert response.json()["archived"] == []
+
+
+def test_poll_backoff(monkeypatch) -> None:
+    """Test that the polling only backs off if the webhook is configured."""
+
+    def poll_intervals() -> list[float]:
+        intervals = []
+
+        async def sleep(interval: float) -> None:
+            intervals.append(interval)
+            if len(intervals) == 3:
+                raise asyncio.CancelledError
+
+        async def track_branches() -> bool:
+            return False
+
+        monkeypatch.setattr(cron, "sleep", sleep)
+        monkeypatch.setattr(cron, "track_branches", track_branches)
+        try:
+            asyncio.run(cron.poll_branches())
+        except asyncio.CancelledError:
+            pass
+        return intervals
+
+    assert poll_intervals() == [300, 300, 300]
+    init_settings.git.webhook_secret = "secret"
+    try:
+        assert poll_intervals() == [300, 600, 1200]
+    finally:
+        init_settings.git.webhook_secret = None
+
+
+def test_maintenance_continues_after_errors(monkeypatch) -> None:
+    """Test that the scheduled maintenance keeps running if a maintenance run fails."""
+    runs = []
+
+    async def sleep(_: float) -> None:
+        if len(runs) == 2:
+            raise asyncio.CancelledError
+
+    async def run_maintenance() -> None:
+        runs.append(len(runs))
+        raise OSError
+
+    monkeypatch.setattr(cron, "sleep", sleep)
+    monkeypatch.setattr(cron, "run_maintenance", run_maintenance)
+    monkeypatch.setattr(init_settings.git, "maintenance_hour", 3)
+    try:
+        asyncio.run(cron.schedule_maintenance())
+    except asyncio.CancelledError:
+        pass
+    assert runs == [0, 1]
@@ -9,6 +9,7 @@ def test_basic_tei_config(simple_app: TestClient) -> None:
     assert response.status_code == 200
     assert response.json() == {
         "ui": {"css_files": []},
+        "exclude": [],
         "tei": {"blocks": [], "marks": [], "sections": []},
     }
 
@@ -19,6 +20,7 @@ def test_complex_tei_config(tei_app: TestClient) -> None:
     assert response.status_code == 200
     assert response.json() == {
         "ui": {"css_files": ["static/style.css"]},
+        "exclude": [],
         "tei": {
             "blocks": [
                 {
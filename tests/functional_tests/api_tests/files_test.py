@@ -2,10 +2,22 @@
 
 import json
 import os
+import shutil
 
+import pygit2
 from fastapi.testclient import TestClient
 
+from uedition_editor.api.files import (
+    BLOB_CHUNK_SIZE,
+    cached_git_file_tree,
+    is_ignored,
+    parse_ignore_patterns,
+    stream_files,
+    stream_git_files,
+)
+from uedition_editor.api.util import branch_commit
 from uedition_editor.settings import init_settings
+from uedition_editor.state import new_folders
 
 
 def test_list_files(simple_app: TestClient) -> None:
@@ -692,3 +704,315 @@ def test_rename_file_rename_folder_into_itself(simple_app: TestClient) -> None:
         headers={"X-uEditor-New-Type": "folder", "X-uEditor-Rename-From": "en"},
     )
     assert response.status_code == 422
+
+
+def test_list_files_from_git(git_app: TestClient) -> None:
+    """Test that the files are listed from the latest commit."""
+    with open(os.path.join(init_settings.base_path, "untracked.md"), "w") as out_f:
+        out_f.write("# Untracked")
+    response = git_app.get("/api/branches/main/files")
+    assert response.status_code == 200
+    names = [entry["name"] for entry in response.json()[0]["content"]]
+    assert names == [
+        "en",
+        ".gitignore",
+        ".uEdition.answers",
+        "pyproject.toml",
+        "toc.yml",
+        "uEdition.yml",
+        "uEditor.yml",
+    ]
+
+
+def test_list_new_folder_from_git(git_app: TestClient) -> None:
+    """Test that new, empty folders are listed, even though they are not in git."""
+    response = git_app.post("/api/branches/main/files/en/new_dir", headers={"X-uEditor-New-Type": "folder"})
+    assert response.status_code == 204
+    response = git_app.get("/api/branches/main/files")
+    assert response.json()[0]["content"][0]["content"][0] == {
+        "name": "new_dir",
+        "fullpath": "en/new_dir",
+        "type": "folder",
+        "content": [],
+        "mimetype": "application/folder",
+    }
+    response = git_app.delete("/api/branches/main/files/en/new_dir")
+    assert response.status_code == 204
+    response = git_app.get("/api/branches/main/files")
+    assert response.json()[0]["content"][0]["content"][0]["name"] == ".uEdition.answers"
+
+
+def test_list_new_folder_after_restart(git_app: TestClient) -> None:
+    """Test that new, empty folders are found in the working tree if they are not known."""
+    response = git_app.post("/api/branches/main/files/en/new_dir", headers={"X-uEditor-New-Type": "folder"})
+    assert response.status_code == 204
+    os.makedirs(os.path.join(init_settings.base_path, "_build", "html"))
+    new_folders.clear()
+    response = git_app.get("/api/branches/main/files")
+    assert response.json()[0]["content"][0]["content"][0]["fullpath"] == "en/new_dir"
+    assert "_build" not in new_folders["main"]
+    response = git_app.post("/api/branches/main/files/en/new_dir", headers={"X-uEditor-New-Type": "folder"})
+    assert response.status_code == 422
+
+
+def test_fetch_large_file_from_git(git_app: TestClient) -> None:
+    """Test that a large file is streamed from the latest commit."""
+    content = os.urandom(3 * BLOB_CHUNK_SIZE + 1)
+    git_app.post("/api/branches/main/files/en/image.png", headers={"X-uEditor-New-Type": "file"})
+    response = git_app.put("/api/branches/main/files/en/image.png", files={"content": content})
+    assert response.status_code == 204
+    response = git_app.get("/api/branches/main/files/en/image.png")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "image/png"
+    assert response.headers["Content-Length"] == str(len(content))
+    assert response.content == content
+
+
+def test_fetch_file_from_git(git_app: TestClient) -> None:
+    """Test that a file is read from the latest commit."""
+    with open(os.path.join(init_settings.base_path, "en", "index.md"), "w") as out_f:
+        out_f.write("# Uncommitted")
+    response = git_app.get("/api/branches/main/files/en/index.md")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/markdown")
+    assert response.text != "# Uncommitted"
+    response = git_app.get("/api/branches/main/files/en")
+    assert response.status_code == 404
+
+
+def test_commit_only_changed_paths(git_app: TestClient) -> None:
+    """Test that only the changed file is committed."""
+    with open(os.path.join(init_settings.base_path, "untracked.md"), "w") as out_f:
+        out_f.write("# Untracked")
+    response = git_app.put("/api/branches/main/files/en/index.md", files={"content": b"# This is new"})
+    assert response.status_code == 204
+    repo = pygit2.Repository(init_settings.base_path)
+    assert repo.revparse_single("main:en/index.md").data == b"# This is new"
+    assert "untracked.md" not in repo.revparse_single("main").tree
+    assert repo.revparse_single("main").message == "Updated en/index.md"
+
+
+def test_do_not_commit_ignored_file(git_app: TestClient) -> None:
+    """Test that a new file that is ignored is not committed."""
+    response = git_app.post("/api/branches/main/files/_config.yml", headers={"X-uEditor-New-Type": "file"})
+    assert response.status_code == 204
+    assert os.path.isfile(os.path.join(init_settings.base_path, "_config.yml"))
+    assert "_config.yml" not in pygit2.Repository(init_settings.base_path).revparse_single("main").tree
+
+
+def test_commit_renamed_folder(git_app: TestClient) -> None:
+    """Test that renaming a folder commits the removal and the addition."""
+    response = git_app.post(
+        "/api/branches/main/files/de", headers={"X-uEditor-New-Type": "folder", "X-uEditor-Rename-From": "en"}
+    )
+    assert response.status_code == 204
+    tree = pygit2.Repository(init_settings.base_path).revparse_single("main").tree
+    assert "de/index.md" in tree
+    assert "en" not in tree
+    response = git_app.delete("/api/branches/main/files/de")
+    assert response.status_code == 204
+    tree = pygit2.Repository(init_settings.base_path).revparse_single("main").tree
+    assert "de" not in tree
+
+
+def test_list_files_cached(simple_app: TestClient) -> None:
+    """Test that the cached tree is rebuilt when files are added outside of the uEditor."""
+    response = simple_app.get("/api/branches/-1/files")
+    assert "new.md" not in [entry["name"] for entry in response.json()[0]["content"][0]["content"]]
+    with open(os.path.join(init_settings.base_path, "en", "new.md"), "w") as out_f:
+        out_f.write("# New")
+    response = simple_app.get("/api/branches/-1/files")
+    assert "new.md" in [entry["name"] for entry in response.json()[0]["content"][0]["content"]]
+
+
+def test_list_files_from_git_cached(git_app: TestClient) -> None:
+    """Test that unchanged folders are reused from the cached tree and new folders do not modify it."""
+    git_app.post("/api/branches/main/files/en/new_dir", headers={"X-uEditor-New-Type": "folder"})
+    git_app.get("/api/branches/main/files")
+    with branch_commit("main") as commit:
+        en_folder = cached_git_file_tree("main", commit)[0]
+    assert [entry["name"] for entry in en_folder["content"]] == [".uEdition.answers", "index.md"]
+    response = git_app.put("/api/branches/main/files/toc.yml", files={"content": b"format: jb-book"})
+    assert response.status_code == 204
+    with branch_commit("main") as commit:
+        assert cached_git_file_tree("main", commit)[0]["content"] is en_folder["content"]
+
+
+def test_list_files_by_level(simple_app: TestClient) -> None:
+    """Test that the tree is limited to the requested depth and path."""
+    response = simple_app.get("/api/branches/-1/files", params={"depth": 1})
+    assert response.status_code == 200
+    assert response.json()[0]["content"][0] == {
+        "name": "en",
+        "fullpath": "en",
+        "type": "folder",
+        "mimetype": "application/folder",
+        "children": 2,
+    }
+    response = simple_app.get("/api/branches/-1/files", params={"path": "en", "depth": 1})
+    assert response.status_code == 200
+    assert response.json()[0]["fullpath"] == "en"
+    assert [entry["name"] for entry in response.json()[0]["content"]] == [".uEdition.answers", "index.md"]
+    response = simple_app.get("/api/branches/-1/files", params={"path": "de"})
+    assert response.status_code == 404
+    response = simple_app.get("/api/branches/-1/files", params={"depth": 0})
+    assert response.status_code == 422
+
+
+def test_ignore_patterns() -> None:
+    """Test that the .gitignore patterns are matched like git does."""
+    patterns = parse_ignore_patterns(["# Comment", "", "*.log", "!keep.log", "/build/", "docs/**/tmp", "cache/"], "en/")
+    assert is_ignored("en/debug.log", False, patterns)
+    assert is_ignored("en/sub/debug.log", False, patterns)
+    assert not is_ignored("debug.log", False, patterns)
+    assert not is_ignored("en/keep.log", False, patterns)
+    assert is_ignored("en/build", True, patterns)
+    assert not is_ignored("en/build", False, patterns)
+    assert not is_ignored("en/sub/build", True, patterns)
+    assert is_ignored("en/docs/tmp", True, patterns)
+    assert is_ignored("en/docs/a/b/tmp", False, patterns)
+    assert is_ignored("en/sub/cache", True, patterns)
+
+
+def test_list_files_ignored(simple_app: TestClient) -> None:
+    """Test that ignored and excluded files and folders are not listed."""
+    os.makedirs(os.path.join(init_settings.base_path, "_static"))
+    os.makedirs(os.path.join(init_settings.base_path, "en", "drafts"))
+    with open(os.path.join(init_settings.base_path, "en", ".gitignore"), "w") as out_f:
+        out_f.write("*.bak\n")
+    with open(os.path.join(init_settings.base_path, "en", "index.bak"), "w") as out_f:
+        out_f.write("# Backup")
+    with open(os.path.join(init_settings.base_path, "uEditor.yml"), "w") as out_f:
+        out_f.write("exclude:\n  - drafts/\n")
+    response = simple_app.get("/api/branches/-1/files")
+    assert "_static" not in [entry["name"] for entry in response.json()[0]["content"]]
+    assert [entry["name"] for entry in response.json()[0]["content"][0]["content"]] == [
+        ".gitignore",
+        ".uEdition.answers",
+        "index.md",
+    ]
+
+
+def test_stream_files(simple_app: TestClient) -> None:
+    """Test that the files are streamed as one JSON object per line."""
+    response = simple_app.get("/api/branches/-1/files", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("application/x-ndjson")
+    entries = [json.loads(line) for line in response.text.splitlines()]
+    assert [entry["fullpath"] for entry in entries[:3]] == ["en", "en/.uEdition.answers", "en/index.md"]
+    assert entries[3] == {
+        "name": ".gitignore",
+        "fullpath": ".gitignore",
+        "type": "file",
+        "mimetype": "application/gitignore",
+    }
+    response = simple_app.get("/api/branches/-1/files", params={"depth": 1}, headers={"Accept": "application/x-ndjson"})
+    assert json.loads(response.text.splitlines()[0])["children"] == 2
+    response = simple_app.get(
+        "/api/branches/-1/files", params={"path": "en"}, headers={"Accept": "application/x-ndjson"}
+    )
+    assert [json.loads(line)["name"] for line in response.text.splitlines()] == [".uEdition.answers", "index.md"]
+    response = simple_app.get(
+        "/api/branches/-1/files", params={"path": "de"}, headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.status_code == 404
+
+
+def test_stream_files_removed_while_streaming(simple_app: TestClient) -> None:  # noqa: ARG001
+    """Test that streaming the files continues if a folder is removed before its content is streamed."""
+    base_path = os.path.abspath(init_settings.base_path)
+    os.makedirs(os.path.join(base_path, "a"))
+    with open(os.path.join(base_path, "a", "removed.md"), "w") as out_f:
+        out_f.write("# Removed")
+    lines = stream_files(base_path, "", None)
+    assert json.loads(next(lines))["fullpath"] == "a"
+    shutil.rmtree(os.path.join(base_path, "a"))
+    assert [json.loads(line)["fullpath"] for line in lines][:3] == ["en", "en/.uEdition.answers", "en/index.md"]
+
+
+def test_stream_files_from_git(git_app: TestClient) -> None:
+    """Test that the files are streamed from the latest commit, followed by the new folders."""
+    git_app.post("/api/branches/main/files/en/new_dir", headers={"X-uEditor-New-Type": "folder"})
+    response = git_app.get("/api/branches/main/files", headers={"Accept": "application/x-ndjson"})
+    assert response.status_code == 200
+    entries = [json.loads(line) for line in response.text.splitlines()]
+    assert [entry["fullpath"] for entry in entries] == [
+        "en",
+        "en/.uEdition.answers",
+        "en/index.md",
+        ".gitignore",
+        ".uEdition.answers",
+        "pyproject.toml",
+        "toc.yml",
+        "uEdition.yml",
+        "uEditor.yml",
+        "en/new_dir",
+    ]
+    response = git_app.get(
+        "/api/branches/main/files", params={"path": "en/new_dir"}, headers={"Accept": "application/x-ndjson"}
+    )
+    assert response.status_code == 200
+    assert response.text == ""
+
+
+def test_stream_files_from_resolved_commit(git_app: TestClient) -> None:
+    """Test that the streamed files are read from the commit that was resolved for the request."""
+    commit_id = str(pygit2.Repository(init_settings.base_path).revparse_single("main").id)
+    response = git_app.delete("/api/branches/main/files/toc.yml")
+    assert response.status_code == 204
+    entries = [json.loads(line) for line in stream_git_files("main", commit_id, "", 1)]
+    assert "toc.yml" in [entry["fullpath"] for entry in entries]
+
+
+def test_list_files_since_tree(git_app: TestClient) -> None:
+    """Test that only the changes since a previous tree are returned."""
+    response = git_app.get("/api/branches/main/files")
+    tree_id = response.headers["X-uEditor-Tree"]
+    response = git_app.post(
+        "/api/branches/main/files/de", headers={"X-uEditor-New-Type": "folder", "X-uEditor-Rename-From": "en"}
+    )
+    assert response.status_code == 204
+    response = git_app.delete("/api/branches/main/files/toc.yml")
+    assert response.status_code == 204
+    response = git_app.get("/api/branches/main/files", params={"since": tree_id})
+    assert response.status_code == 200
+    assert response.headers["X-uEditor-Tree"] != tree_id
+    assert response.json() == {
+        "tree": response.headers["X-uEditor-Tree"],
+        "added": [{"name": "de", "fullpath": "de", "type": "folder", "mimetype": "application/folder"}],
+        "removed": ["en", "toc.yml"],
+        "renamed": [
+            {
+                "from": "en/.uEdition.answers",
+                "to": {
+                    "name": ".uEdition.answers",
+                    "fullpath": "de/.uEdition.answers",
+                    "type": "file",
+                    "mimetype": "application/unknown",
+                },
+            },
+            {
+                "from": "en/index.md",
+                "to": {"name": "index.md", "fullpath": "de/index.md", "type": "file", "mimetype": "text/markdown"},
+            },
+        ],
+    }
+    response = git_app.get("/api/branches/main/files", params={"since": "abc"})
+    assert response.status_code == 422
+
+
+def test_fail_list_files_since_with_path_or_depth(git_app: TestClient) -> None:
+    """Test that the changes since a tree cannot be limited to a path or depth."""
+    response = git_app.get("/api/branches/main/files")
+    tree_id = response.headers["X-uEditor-Tree"]
+    response = git_app.get("/api/branches/main/files", params={"since": tree_id, "path": "en"})
+    assert response.status_code == 422
+    assert response.json()["detail"][0]["loc"] == ["query", "since"]
+    response = git_app.get("/api/branches/main/files", params={"since": tree_id, "depth": 1})
+    assert response.status_code == 422
+
+
+def test_fail_list_files_since_without_git(simple_app: TestClient) -> None:
+    """Test that the changes since a tree cannot be listed without git."""
+    response = simple_app.get("/api/branches/-1/files", params={"since": "abc"})
+    assert response.status_code == 422
@@ -0,0 +1,127 @@
+"""Tests for the API utilities."""
+
+import asyncio
+import os
+
+import pytest
+from fastapi.testclient import TestClient
+from pygit2 import Commit, OdbBackendLoose, Repository, Signature, init_repository
+
+from uedition_editor.api import util
+from uedition_editor.api.util import BranchContextManager, PushQueue, ReadWriteLock, locks, maintain_repository
+from uedition_editor.settings import init_settings
+from uedition_editor.state import RepositoryPool
+
+
+def test_read_write_lock() -> None:
+    """Test that readers share the lock and writers hold it exclusively."""
+    events = []
+
+    async def reader(lock: ReadWriteLock, name: str) -> None:
+        async with lock.read():
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def writer(lock: ReadWriteLock, name: str) -> None:
+        async with lock.write():
+            events.append(f"{name} start")
+            await asyncio.sleep(0.01)
+            events.append(f"{name} end")
+
+    async def run() -> None:
+        lock = ReadWriteLock()
+        await asyncio.gather(reader(lock, "r1"), reader(lock, "r2"), writer(lock, "w1"), reader(lock, "r3"))
+
+    asyncio.run(run())
+    assert events == ["r1 start", "r2 start", "r1 end", "r2 end", "w1 start", "w1 end", "r3 start", "r3 end"]
+
+
+def test_repository_pool(tmp_path) -> None:
+    """Test that repository handles are reused until the pool is invalidated."""
+    init_repository(str(tmp_path))
+    pool = RepositoryPool()
+    repo = pool.acquire(str(tmp_path))
+    assert pool.acquire(str(tmp_path)) is not repo
+    pool.release(repo)
+    with pool.repository(str(tmp_path)) as pooled_repo:
+        assert pooled_repo is repo
+    pool.invalidate()
+    assert pool.acquire(str(tmp_path)) is not repo
+
+
+def create_commits(path: str) -> None:
+    """Create a repository at the `path` with a few commits."""
+    repo = init_repository(path, initial_head="main")
+    signature = Signature("A.N. Editor", "editor@example.com")
+    parents = []
+    for idx in range(3):
+        tree = repo.TreeBuilder()
+        tree.insert("index.md", repo.create_blob(f"# {idx}".encode()), 0o100644)
+        parents = [repo.create_commit("HEAD", signature, signature, f"Commit {idx}", tree.write(), parents)]
+
+
+def test_maintain_repository(tmp_path) -> None:
+    """Test that the maintenance packs all objects and writes a commit-graph."""
+    create_commits(str(tmp_path))
+    repo = init_repository(str(tmp_path))
+    assert len(list(OdbBackendLoose(os.path.join(repo.path, "objects"), 0, False))) > 0
+    maintain_repository(repo)
+    assert list(OdbBackendLoose(os.path.join(repo.path, "objects"), 0, False)) == []
+    assert os.path.exists(os.path.join(repo.path, "objects", "info", "commit-graph"))
+    assert repo.revparse_single("main:index.md").data == b"# 2"
+
+
+def test_maintain_repository_without_git(tmp_path, monkeypatch) -> None:
+    """Test that the maintenance packs the loose objects if git is not installed."""
+    monkeypatch.setattr(util.shutil, "which", lambda _: None)
+    create_commits(str(tmp_path))
+    repo = init_repository(str(tmp_path))
+    maintain_repository(repo)
+    assert list(OdbBackendLoose(os.path.join(repo.path, "objects"), 0, False)) == []
+    assert repo.revparse_single("main:index.md").data == b"# 2"
+
+
+def test_branch_context_manager_releases_lock_on_error(git_app: TestClient, monkeypatch) -> None:  # noqa: ARG001
+    """Test that the branch lock is released if the working tree cannot be provided."""
+    repo = Repository(init_settings.base_path)
+    repo.branches.local.create("broken", repo.head.peel(Commit))
+
+    def fail(*args):  # noqa: ARG001
+        raise OSError
+
+    monkeypatch.setattr(util, "branch_repository", fail)
+
+    async def run() -> None:
+        manager = BranchContextManager("broken")
+        with pytest.raises(OSError):
+            async with manager:
+                pass
+        async with asyncio.timeout(1), locks.branch("broken").write():
+            pass
+
+    asyncio.run(run())
+
+
+def test_push_queue_retries_unexpected_errors(monkeypatch) -> None:
+    """Test that the push queue keeps running and retries the push if it fails with an unexpected error."""
+    pushed = []
+
+    def fail(branch: str) -> None:
+        pushed.append(branch)
+        raise OSError
+
+    monkeypatch.setattr(util, "push_branch", fail)
+
+    async def run() -> None:
+        queue = PushQueue()
+        queue.start()
+        queue.enqueue("main")
+        await asyncio.sleep(0.1)
+        assert pushed == ["main"]
+        assert queue.is_pending("main")
+        assert not queue._task.done()
+        queue.discard("main")
+        await queue.stop()
+
+    asyncio.run(run())
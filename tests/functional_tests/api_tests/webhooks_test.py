@@ -0,0 +1,115 @@
+"""Tests for the webhooks API."""
+
+import hmac
+import json
+from hashlib import sha256
+
+from fastapi.testclient import TestClient
+from httpx import Response
+from pygit2 import Repository
+
+from tests.functional_tests.api_tests.branches_test import add_remote, commit_to_remote
+from uedition_editor.settings import init_settings
+from uedition_editor.state import repositories
+
+
+def post_webhook(client: TestClient, payload: dict, secret: str = "secret") -> Response:
+    """Post the signed `payload` to the git webhook."""
+    body = json.dumps(payload).encode()
+    signature = "sha256=" + hmac.new(secret.encode(), body, sha256).hexdigest()
+    return client.post(
+        "/api/webhooks/git",
+        content=body,
+        headers={"Content-Type": "application/json", "X-Hub-Signature-256": signature},
+    )
+
+
+def test_webhook_disabled(git_app: TestClient) -> None:
+    """Test that the webhook is not available without a secret."""
+    response = post_webhook(git_app, {"ref": "refs/heads/main"})
+    assert response.status_code == 404
+
+
+def test_webhook_invalid_signature(git_app: TestClient) -> None:
+    """Test that the webhook rejects requests that are not correctly signed."""
+    init_settings.git.webhook_secret = "secret"
+    try:
+        response = post_webhook(git_app, {"ref": "refs/heads/main"}, secret="wrong")
+        assert response.status_code == 403
+        response = git_app.post("/api/webhooks/git", json={"ref": "refs/heads/main"})
+        assert response.status_code == 403
+    finally:
+        init_settings.git.webhook_secret = None
+
+
+def test_webhook_fetches_refs(git_app: TestClient, tmp_path) -> None:
+    """Test that the webhook fetches the updated refs and pulls them into the local branches."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    commit_to_remote(remote, str(tmp_path / "clone"), "main", b"# Remote")
+    init_settings.git.webhook_secret = "secret"
+    try:
+        response = post_webhook(git_app, {"ref": "refs/heads/main", "after": str(remote.branches["main"].target)})
+        assert response.status_code == 202
+    finally:
+        init_settings.git.webhook_secret = None
+    repo = Repository(init_settings.base_path)
+    assert repo.branches["main"].target == remote.branches["main"].target
+    response = git_app.get("/api/branches/main/files/en/index.md")
+    assert response.text == "# Remote"
+
+
+def test_webhook_pull_keeps_index_of_pooled_handles(git_app: TestClient, tmp_path) -> None:
+    """Test that a save after the webhook pulled the branch does not revert the pulled changes."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    response = git_app.put("/api/branches/main/files/toc.yml", files={"content": b"format: jb-book"})
+    assert response.status_code == 204
+    commit_to_remote(remote, str(tmp_path / "clone"), "main", b"# Remote")
+    stale_repo = repositories.acquire(init_settings.base_path)
+    assert stale_repo.index["en/index.md"] is not None
+    init_settings.git.webhook_secret = "secret"
+    try:
+        response = post_webhook(git_app, {"ref": "refs/heads/main", "after": str(remote.branches["main"].target)})
+        assert response.status_code == 202
+    finally:
+        init_settings.git.webhook_secret = None
+        repositories.release(stale_repo)
+    response = git_app.put("/api/branches/main/files/toc.yml", files={"content": b"format: jb-article"})
+    assert response.status_code == 204
+    assert Repository(init_settings.base_path).revparse_single("main:en/index.md").data == b"# Remote"
+
+
+def test_webhook_tracked_created_branch(git_app: TestClient, tmp_path) -> None:
+    """Test that a branch created on the remote is listed after the webhook in the tracked fetch mode."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    init_settings.git.fetch_mode = "tracked"
+    init_settings.git.webhook_secret = "secret"
+    try:
+        git_app.patch("/api/branches")
+        remote.branches.local.create("other", remote.branches["main"].peel())
+        response = post_webhook(git_app, {"ref": "refs/heads/other", "after": str(remote.branches["other"].target)})
+        assert response.status_code == 202
+        response = git_app.get("/api/branches")
+        assert [branch["id"] for branch in response.json()["remote"]] == ["origin/main", "origin/other"]
+    finally:
+        init_settings.git.fetch_mode = "all"
+        init_settings.git.webhook_secret = None
+
+
+def test_webhook_tracked_deleted_branch(git_app: TestClient, tmp_path) -> None:
+    """Test that a branch deleted on the remote is no longer listed after the webhook in the tracked fetch mode."""
+    remote = add_remote(str(tmp_path / "remote.git"))
+    remote.branches.local.create("other", remote.branches["main"].peel())
+    init_settings.git.fetch_mode = "tracked"
+    init_settings.git.webhook_secret = "secret"
+    try:
+        git_app.patch("/api/branches")
+        response = git_app.get("/api/branches")
+        assert [branch["id"] for branch in response.json()["remote"]] == ["origin/main", "origin/other"]
+        remote.branches.delete("other")
+        response = post_webhook(git_app, {"ref": "refs/heads/other", "deleted": True})
+        assert response.status_code == 202
+        response = git_app.get("/api/branches")
+        assert [branch["id"] for branch in response.json()["remote"]] == ["origin/main"]
+    finally:
+        init_settings.git.fetch_mode = "all"
+        init_settings.git.webhook_secret = None
@@ -0,0 +1,77 @@
+"""Tests for the CLI application."""
+
+import shutil
+import socket
+import subprocess
+import time
+from typing import Generator
+
+import pytest
+from pygit2 import Repository, Signature, init_repository
+from typer.testing import CliRunner
+
+from uedition_editor.cli import app
+from uedition_editor.settings import init_settings
+
+
+@pytest.fixture
+def git_daemon(tmp_path) -> Generator[str, None, None]:
+    """
+    Yield the URL of a bare repository with two commits on its default branch, served by a git daemon.
+
+    The local transport does not support shallow clones, so the repository is served via the git protocol.
+    """
+    git = shutil.which("git")
+    if git is None:
+        pytest.skip("git is not installed")
+    remote = init_repository(str(tmp_path / "remote.git"), bare=True)
+    signature = Signature("Remote Editor", "remote@example.com")
+    tree = remote.TreeBuilder().write()
+    first = remote.create_commit(
+        f"refs/heads/{init_settings.git.default_branch}", signature, signature, "First", tree, []
+    )
+    remote.create_commit(
+        f"refs/heads/{init_settings.git.default_branch}", signature, signature, "Second", tree, [first]
+    )
+    remote.set_head(f"refs/heads/{init_settings.git.default_branch}")
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    daemon = subprocess.Popen(  # noqa: S603
+        [
+            git,
+            "daemon",
+            "--export-all",
+            "--reuseaddr",
+            "--listen=127.0.0.1",
+            f"--port={port}",
+            f"--base-path={tmp_path}",
+            str(tmp_path),
+        ]
+    )
+    try:
+        for _ in range(50):
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield f"git://127.0.0.1:{port}/remote.git"
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+
+def test_git_clone_shallow(git_daemon: str, tmp_path, monkeypatch) -> None:
+    """Test that cloning with a depth creates a shallow clone with the default branch tracking the remote."""
+    monkeypatch.setattr(init_settings, "base_path", str(tmp_path / "clone"))
+    result = CliRunner().invoke(app, ["git", "clone", "--url", git_daemon, "--depth", "1"])
+    assert result.exit_code == 0
+    assert f"Cloned the latest 1 commits of {init_settings.git.default_branch}" in result.output
+    repo = Repository(str(tmp_path / "clone"))
+    assert repo.is_shallow
+    assert repo.head.shorthand == init_settings.git.default_branch
+    assert repo.head.peel().parent_ids == []
+    assert list(repo.remotes.names()) == [init_settings.git.remote_name]
+    upstream = repo.branches[init_settings.git.default_branch].upstream
+    assert upstream.branch_name == f"{init_settings.git.remote_name}/{init_settings.git.default_branch}"
@@ -3,6 +3,7 @@
 from typing import Generator
 
 from fastapi.testclient import TestClient
+from pygit2 import Signature, init_repository
 from pytest import fixture
 
 from uedition_editor import app
@@ -47,3 +48,27 @@ def tei_app() -> Generator[TestClient, None, None]:
         yield client
     finally:
         client.delete("/api/tests/fixtures")
+
+
+@fixture
+def git_app() -> Generator[TestClient, None, None]:
+    """Yield a uEditor application for a simple uEdition in a git repository."""
+    try:
+        init_settings.auth.name = "A.N. Editor"
+        init_settings.auth.email = "editor@example.com"
+        client = TestClient(app)
+        client.post("/api/tests/fixtures/simple")
+        repo = init_repository(init_settings.base_path, initial_head=init_settings.git.default_branch)
+        index = repo.index
+        index.add_all()
+        index.write()
+        signature = Signature(init_settings.auth.name, init_settings.auth.email)
+        repo.create_commit("HEAD", signature, signature, "Initial state", index.write_tree(), [])
+        client.post("/api/auth/login")
+        client.cookies["ueditor_user"] = client.cookies["ueditor_user"]
+        client.patch("/api/branches")
+        yield client
+    finally:
+        client.delete("/api/tests/fixtures")
+        init_settings.auth.name = ""
+        init_settings.auth.email = ""
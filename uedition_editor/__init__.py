@@ -4,7 +4,8 @@
 """The main uEditor server."""
 
 import logging
-from contextlib import asynccontextmanager
+from asyncio import CancelledError, create_task
+from contextlib import asynccontextmanager, suppress
 from copy import deepcopy
 
 from fastapi import FastAPI
@@ -16,6 +17,7 @@ from uvicorn.config import LOGGING_CONFIG
 
 from uedition_editor import cron
 from uedition_editor.api import router as api_router
+from uedition_editor.api.util import push_queue
 from uedition_editor.settings import init_settings
 
 logger = logging.getLogger(__name__)
@@ -37,8 +39,19 @@ logger.debug("Logging configuration set up")
 @asynccontextmanager
 async def lifespan(app: FastAPI):  # noqa:ARG001
     """Startup/shutdown handler."""
-    await cron.track_branches.func()
+    await cron.track_branches()
+    push_queue.start()
+    tasks = []
+    if init_settings.git.poll_interval > 0:
+        tasks.append(create_task(cron.poll_branches()))
+    if init_settings.git.maintenance_hour is not None:
+        tasks.append(create_task(cron.schedule_maintenance()))
     yield
+    for task in tasks:
+        task.cancel()
+        with suppress(CancelledError):
+            await task
+    await push_queue.stop()
 
 
 app = FastAPI(lifespan=lifespan)
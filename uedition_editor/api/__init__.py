@@ -7,17 +7,19 @@ from typing import Literal
 
 from fastapi import APIRouter
 from pydantic import BaseModel
-from pygit2 import GitError, Repository
-from pygit2.enums import RepositoryOpenFlag
+from pygit2 import GitError
 
 from uedition_editor.__about__ import __version__
 from uedition_editor.api.auth import router as auth_router
 from uedition_editor.api.branches import router as branches_router
+from uedition_editor.api.webhooks import router as webhooks_router
 from uedition_editor.settings import init_settings
+from uedition_editor.state import repositories
 
 router = APIRouter(prefix="/api")
 router.include_router(auth_router)
 router.include_router(branches_router)
+router.include_router(webhooks_router)
 if init_settings.test:  # pragma: no cover
     from uedition_editor.api.tests import router as tests_router
 
@@ -66,11 +68,11 @@ def api() -> dict:
         "version": __version__,
     }
     try:
-        repo = Repository(init_settings.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
-        api_status["git"]["enabled"] = True
-        api_status["git"]["has_remote"] = len(repo.remotes) > 0
-        api_status["git"]["default_branch"] = init_settings.git.default_branch
-        api_status["git"]["protect_default_branch"] = init_settings.git.protect_default_branch
+        with repositories.repository(init_settings.base_path) as repo:
+            api_status["git"]["enabled"] = True
+            api_status["git"]["has_remote"] = len(repo.remotes) > 0
+            api_status["git"]["default_branch"] = init_settings.git.default_branch
+            api_status["git"]["protect_default_branch"] = init_settings.git.protect_default_branch
     except GitError:
         pass
     return api_status
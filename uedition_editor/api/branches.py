@@ -9,26 +9,39 @@ from typing import Annotated
 from fastapi import APIRouter, Depends, Header
 from fastapi.exceptions import HTTPException
 from pydantic import BaseModel, Field
-from pygit2 import GitError, Repository, Signature
-from pygit2.enums import MergeFlag, RepositoryOpenFlag, ResetMode
+from pygit2 import Commit, GitError, Oid, Repository, Signature
+from pygit2.enums import MergeFlag
 
 from uedition_editor import cron
 from uedition_editor.api.auth import get_current_user
 from uedition_editor.api.configs import router as configs_router
 from uedition_editor.api.files import router as files_router
 from uedition_editor.api.util import (
-    BranchContextManager,
+    ARCHIVE_REF_PREFIX,
     RemoteRepositoryCallbacks,
-    commit_and_push,
     de_slugify,
-    fetch_and_pull_branch,
-    fetch_repo,
+    fetch_remote,
+    fetch_remote_refs,
+    locks,
     pull_branch,
+    push_queue,
+    remote_branch_names,
+    remove_branch_worktree,
+    restore_branch,
+    run_blocking,
+    schedule_push,
     slugify,
-    uedition_lock,
+    update_branch,
 )
 from uedition_editor.settings import init_settings
-from uedition_editor.state import local_branches, remote_branches
+from uedition_editor.state import (
+    archived_branches,
+    local_branches,
+    merge_preview_cache,
+    new_folders,
+    remote_branches,
+    repositories,
+)
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/branches")
@@ -44,13 +57,16 @@ class BranchModel(BaseModel):
     nogit: bool = False
     update_from_default: bool = False
     modified_files: list[str] = []
+    pending_push: bool = False
+    push_rejected: bool = False
 
 
 class BranchesModel(BaseModel):
-    """A model combining local and remote branches."""
+    """A model combining local, remote, and archived branches."""
 
     local: list[BranchModel]
     remote: list[BranchModel]
+    archived: list[BranchModel] = []
 
 
 @router.get("", response_model=BranchesModel)
@@ -58,13 +74,24 @@ async def branches(
     current_user: Annotated[dict, Depends(get_current_user)],  # noqa:ARG001
 ) -> list:
     """Fetch the available branches."""
-    return {"local": local_branches, "remote": remote_branches}
+    return {
+        "local": [
+            {
+                **branch,
+                "pending_push": push_queue.is_pending(branch["id"].replace("%252F", "/")),
+                "push_rejected": push_queue.is_rejected(branch["id"].replace("%252F", "/")),
+            }
+            for branch in local_branches
+        ],
+        "remote": remote_branches,
+        "archived": archived_branches,
+    }
 
 
 @router.patch("", status_code=204)
 async def synchronise_remote() -> None:
     """Synchronise with the git remote."""
-    await cron.track_branches.func()
+    await cron.synchronise_branches()
 
 
 class CreateBranchModel(BaseModel):
@@ -80,50 +107,79 @@ async def create_branch(
     x_ueditor_import_branch: Annotated[bool, Header()] = False,  # noqa: FBT002
 ) -> dict:
     """Create a new branch."""
-    async with uedition_lock:
+    async with locks.repository:
         try:
             branch_id = slugify(data.title)
-            repo = Repository(init_settings.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
-            if branch_id in repo.branches.local:
-                raise HTTPException(422, detail=[{"msg": "this branch name is already in use"}])
-            if init_settings.git.remote_name in list(repo.remotes.names()):
-                fetch_and_pull_branch(
-                    repo,
-                    init_settings.git.remote_name,
-                    init_settings.git.default_branch,
-                )
-            repo.checkout(repo.branches[init_settings.git.default_branch])
-            if x_ueditor_import_branch:
-                commit, reference = repo.resolve_refish(f"{init_settings.git.remote_name}/{branch_id}")
-                repo.branches.local.create(branch_id, commit)
-                repo.checkout(repo.branches[branch_id])
-                repo.branches[branch_id].upstream = repo.branches[f"{init_settings.git.remote_name}/{branch_id}"]
-                await cron.insecure_track_branches()
-                return {"id": branch_id, "title": de_slugify(data.title)}
-            else:
-                for remote_branch_id in repo.branches.remote:
-                    if remote_branch_id.endswith(branch_id):
-                        raise HTTPException(
-                            422,
-                            detail=[{"msg": "this branch name is already used in the remote repository"}],
-                        )
-                last_default_commit = repo.revparse_single(str(repo.branches[init_settings.git.default_branch].target))
-                repo.branches.local.create(branch_id, last_default_commit)
-                repo.checkout(repo.branches[branch_id])
+            with repositories.repository(init_settings.base_path) as repo:
+                if branch_id in repo.branches.local:
+                    raise HTTPException(422, detail=[{"msg": "this branch name is already in use"}])
                 if init_settings.git.remote_name in list(repo.remotes.names()):
-                    repo.remotes[init_settings.git.remote_name].push(
-                        [f"refs/heads/{branch_id}"],
-                        callbacks=RemoteRepositoryCallbacks(),
-                    )
-                    fetch_repo(repo, init_settings.git.remote_name)
+                    await fetch_remote(repo, max_age=init_settings.git.fetch_max_age)
+                    async with locks.branch(init_settings.git.default_branch).write():
+                        await run_blocking(pull_branch, repo, init_settings.git.default_branch)
+                if x_ueditor_import_branch:
+                    if f"{init_settings.git.remote_name}/{branch_id}" not in repo.branches.remote:
+                        await fetch_remote_refs(repo, [f"refs/heads/{branch_id}"])
+                    commit, reference = repo.resolve_refish(f"{init_settings.git.remote_name}/{branch_id}")
+                    repo.branches.local.create(branch_id, commit)
                     repo.branches[branch_id].upstream = repo.branches[f"{init_settings.git.remote_name}/{branch_id}"]
-                await cron.insecure_track_branches()
-                return {"id": branch_id, "title": data.title}
+                    await cron.insecure_track_branches()
+                    return {"id": branch_id, "title": de_slugify(data.title)}
+                else:
+                    for remote_branch_id in set(repo.branches.remote) | set(remote_branch_names(repo)):
+                        if remote_branch_id.endswith(branch_id):
+                            raise HTTPException(
+                                422,
+                                detail=[{"msg": "this branch name is already used in the remote repository"}],
+                            )
+                    last_default_commit = repo.revparse_single(
+                        str(repo.branches[init_settings.git.default_branch].target)
+                    )
+                    repo.branches.local.create(branch_id, last_default_commit)
+                    if init_settings.git.remote_name in list(repo.remotes.names()):
+                        await run_blocking(
+                            repo.remotes[init_settings.git.remote_name].push,
+                            [f"refs/heads/{branch_id}"],
+                            callbacks=RemoteRepositoryCallbacks(),
+                        )
+                        await fetch_remote_refs(repo, [f"refs/heads/{branch_id}"])
+                        repo.branches[branch_id].upstream = repo.branches[
+                            f"{init_settings.git.remote_name}/{branch_id}"
+                        ]
+                    await cron.insecure_track_branches()
+                    return {"id": branch_id, "title": data.title}
         except GitError as ge:
             logger.error(ge)
             raise HTTPException(500, "Git error") from ge
 
 
+def merge_trees(repo: Repository, ours: Commit, theirs: Commit) -> Oid:
+    """Merge the `theirs` commit into the `ours` commit in memory and return the resulting tree."""
+    index = repo.merge_commits(ours, theirs, flags=MergeFlag.FIND_RENAMES)
+    if index.conflicts is not None:
+        raise GitError("Merge conflicts prevented merging")  # noqa: EM101
+    return index.write_tree(repo)
+
+
+def merge_default_into_branch(repo: Repository, branch_id: str, author: Signature) -> None:
+    """Merge the default branch into the `branch_id` in memory."""
+    branch_head = repo.branches.local[branch_id].peel(Commit)
+    default_branch_head = repo.branches.local[init_settings.git.default_branch].peel(Commit)
+    if branch_head.id == default_branch_head.id or repo.descendant_of(branch_head.id, default_branch_head.id):
+        return
+    tree = merge_trees(repo, branch_head, default_branch_head)
+    new_commit = repo.create_commit(
+        None,
+        author,
+        author,
+        f"Merged branch {init_settings.git.default_branch} into {branch_id}",
+        tree,
+        [branch_head.id, default_branch_head.id],
+    )
+    update_branch(repo, branch_id, new_commit)
+    schedule_push(repo, init_settings.git.remote_name, branch_id)
+
+
 @router.post("/{branch_id}/merge-from-default", status_code=204)
 async def merge_from_default(
     branch_id: str,
@@ -131,30 +187,42 @@ async def merge_from_default(
 ) -> None:
     """Merge all changes from the default branch."""
     branch_id = branch_id.replace("%2F", "/")
-    async with BranchContextManager(branch_id) as repo:
-        try:
-            repo.checkout(repo.branches[init_settings.git.default_branch])
-            if init_settings.git.remote_name in list(repo.remotes.names()):
-                fetch_repo(repo, init_settings.git.remote_name)
-                pull_branch(repo, init_settings.git.default_branch)
-            repo.checkout(repo.branches[branch_id])
-            default_branch_head = repo.revparse_single(init_settings.git.default_branch)
-            diff = repo.diff(default_branch_head)
-            if diff.stats.files_changed > 0:
-                repo.merge(default_branch_head.id, flags=MergeFlag.FAIL_ON_CONFLICT | MergeFlag.FIND_RENAMES)
-                new_commit = commit_and_push(
-                    repo,
-                    init_settings.git.remote_name,
-                    branch_id,
-                    f"Merged branch {init_settings.git.default_branch} into {branch_id}",
-                    Signature(current_user["name"], current_user["sub"]),
-                    extra_parents=[default_branch_head.id],
-                )
-                repo.reset(new_commit, ResetMode.HARD)
-            await cron.insecure_track_branches()
-        except GitError as ge:
-            logger.error(ge)
-            raise HTTPException(409, [{"msg": "Merge conflicts prevented merging"}]) from ge
+    if init_settings.git.default_branch == branch_id:
+        raise HTTPException(422, detail=[{"msg": "you cannot merge the default branch with itself"}])
+    async with locks.repository:
+        async with locks.branch(branch_id).write():
+            with repositories.repository(init_settings.base_path) as repo:
+                if repo.lookup_branch(branch_id) is None:
+                    raise HTTPException(404)
+                try:
+                    if init_settings.git.remote_name in list(repo.remotes.names()):
+                        await fetch_remote(repo, max_age=init_settings.git.fetch_max_age)
+                        async with locks.branch(init_settings.git.default_branch).write():
+                            await run_blocking(pull_branch, repo, init_settings.git.default_branch)
+                    await run_blocking(
+                        merge_default_into_branch, repo, branch_id, Signature(current_user["name"], current_user["sub"])
+                    )
+                except GitError as ge:
+                    logger.error(ge)
+                    raise HTTPException(409, [{"msg": "Merge conflicts prevented merging"}]) from ge
+        await cron.insecure_track_branches()
+
+
+def merge_branch_into_default(repo: Repository, branch_id: str, author: Signature) -> None:
+    """
+    Merge the `branch_id` into the default branch in memory and delete it.
+
+    If the merge does not change the default branch, then no commit is created.
+    """
+    default_branch_head = repo.branches.local[init_settings.git.default_branch].peel(Commit)
+    branch_head = repo.branches.local[branch_id].peel(Commit)
+    tree = merge_trees(repo, default_branch_head, branch_head)
+    if tree != default_branch_head.tree_id:
+        new_commit = repo.create_commit(None, author, author, de_slugify(branch_id), tree, [default_branch_head.id])
+        update_branch(repo, init_settings.git.default_branch, new_commit)
+        schedule_push(repo, init_settings.git.remote_name, init_settings.git.default_branch)
+    remove_branch_worktree(repo, branch_id)
+    repo.branches.delete(branch_id)
 
 
 @router.post("/{branch_id}/merge-into-default", status_code=204)
@@ -164,25 +232,100 @@ async def merge_into_default(
 ) -> None:
     """Merge all changes into the default branch and delete the current branch."""
     branch_id = branch_id.replace("%2F", "/")
-    async with BranchContextManager(branch_id) as repo:
+    if init_settings.git.default_branch == branch_id:
+        raise HTTPException(422, detail=[{"msg": "you cannot merge the default branch with itself"}])
+    async with locks.repository:
+        async with locks.branch(branch_id).write(), locks.branch(init_settings.git.default_branch).write():
+            with repositories.repository(init_settings.base_path) as repo:
+                if repo.lookup_branch(branch_id) is None:
+                    raise HTTPException(404)
+                try:
+                    await run_blocking(
+                        merge_branch_into_default, repo, branch_id, Signature(current_user["name"], current_user["sub"])
+                    )
+                    new_folders.pop(branch_id, None)
+                    push_queue.discard(branch_id)
+                except GitError as ge:
+                    logger.error(ge)
+                    raise HTTPException(409, [{"msg": "Merge conflicts prevented merging"}]) from ge
+        await cron.insecure_track_branches()
+
+
+@router.post("/{branch_id}/restore", response_model=BranchModel)
+async def restore_archived_branch(
+    branch_id: str,
+    current_user: Annotated[dict, Depends(get_current_user)],  # noqa:ARG001
+) -> dict:
+    """Restore an archived branch."""
+    branch_id = branch_id.replace("%2F", "/")
+    async with locks.repository:
         try:
-            repo.checkout(repo.branches[branch_id])
-            current_branch_head = repo.revparse_single(branch_id)
-            repo.checkout(repo.branches[init_settings.git.default_branch])
-            repo.merge(current_branch_head.id, flags=MergeFlag.FAIL_ON_CONFLICT | MergeFlag.FIND_RENAMES)
-            new_commit = commit_and_push(
-                repo,
-                init_settings.git.remote_name,
-                branch_id,
-                de_slugify(branch_id),
-                Signature(current_user["name"], current_user["sub"]),
-            )
-            repo.branches.delete(branch_id)
-            repo.reset(new_commit, ResetMode.HARD)
-            await cron.insecure_track_branches()
+            with repositories.repository(init_settings.base_path) as repo:
+                if branch_id in repo.branches.local:
+                    raise HTTPException(422, detail=[{"msg": "this branch name is already in use"}])
+                if f"{ARCHIVE_REF_PREFIX}{branch_id}" not in repo.references:
+                    raise HTTPException(404)
+                restore_branch(repo, branch_id)
         except GitError as ge:
-            logger.error(ge)
-            raise HTTPException(409, [{"msg": "Merge conflicts prevented merging"}]) from ge
+            raise HTTPException(404) from ge
+        await cron.insecure_track_branches()
+    return {"id": branch_id.replace("/", "%252F"), "title": de_slugify(branch_id)}
+
+
+class MergePreviewModel(BaseModel):
+    """A model of the result of merging a branch with the default branch."""
+
+    conflicts: list[str]
+    """Paths that conflict between the branch and the default branch."""
+    into_default: list[str]
+    """Paths that merging the branch into the default branch changes."""
+    from_default: list[str]
+    """Paths that merging the default branch into the branch changes."""
+
+
+def merge_preview_status(repo: Repository, branch_id: str) -> dict:
+    """Merge the `branch_id` and the default branch in memory, without updating either branch."""
+    default_branch_head = repo.branches.local[init_settings.git.default_branch].peel(Commit)
+    branch_head = repo.branches.local[branch_id].peel(Commit)
+    merge_base = repo.get(repo.merge_base(default_branch_head.id, branch_head.id))
+    index = repo.merge_commits(default_branch_head, branch_head, flags=MergeFlag.FIND_RENAMES)
+    conflicts = set()
+    if index.conflicts is not None:
+        for ancestor, ours, theirs in index.conflicts:
+            conflicts.add((ours or theirs or ancestor).path)
+    return {
+        "conflicts": sorted(conflicts),
+        "into_default": [delta.new_file.path for delta in merge_base.tree.diff_to_tree(branch_head.tree).deltas],
+        "from_default": [
+            delta.new_file.path for delta in merge_base.tree.diff_to_tree(default_branch_head.tree).deltas
+        ],
+    }
+
+
+@router.get("/{branch_id}/merge-preview", response_model=MergePreviewModel)
+async def merge_preview(
+    branch_id: str,
+    current_user: Annotated[dict, Depends(get_current_user)],  # noqa:ARG001
+) -> dict:
+    """
+    Preview merging the branch with the default branch.
+
+    The preview is cached until either branch changes.
+    """
+    branch_id = branch_id.replace("%2F", "/")
+    if init_settings.git.default_branch == branch_id:
+        raise HTTPException(422, detail=[{"msg": "you cannot merge the default branch with itself"}])
+    try:
+        with repositories.repository(init_settings.base_path) as repo:
+            branch = repo.lookup_branch(branch_id)
+            if branch is None:
+                raise HTTPException(404)
+            key = (str(branch.target), str(repo.branches.local[init_settings.git.default_branch].target))
+            if branch_id not in merge_preview_cache or merge_preview_cache[branch_id][0] != key:
+                merge_preview_cache[branch_id] = (key, await run_blocking(merge_preview_status, repo, branch_id))
+            return merge_preview_cache[branch_id][1]
+    except GitError as ge:
+        raise HTTPException(404) from ge
 
 
 @router.delete("/{branch_id}", status_code=204)
@@ -193,17 +336,30 @@ async def delete_branch(
 ) -> None:
     """Delete the given branch locally and remotely."""
     branch_id = branch_id.replace("%2F", "/")
-    async with BranchContextManager(branch_id) as repo:
-        if init_settings.git.remote_name in repo.remotes.names():
-            fetch_and_pull_branch(repo, init_settings.git.remote_name, branch_id)
-        if init_settings.git.default_branch == branch_id:
-            raise HTTPException(422, detail=[{"msg": "you cannot delete the default branch"}])
-        repo.checkout(repo.branches[init_settings.git.default_branch])
-        if init_settings.git.remote_name in list(repo.remotes.names()) and not local_delete:
-            if repo.branches[branch_id].upstream is not None:
-                repo.remotes[init_settings.git.remote_name].push(
-                    [f":refs/heads/{branch_id}"], callbacks=RemoteRepositoryCallbacks()
-                )
-        if branch_id in repo.branches:
-            repo.branches.delete(branch_id)
+    if init_settings.git.default_branch == branch_id:
+        raise HTTPException(422, detail=[{"msg": "you cannot delete the default branch"}])
+    async with locks.repository:
+        async with locks.branch(branch_id).write():
+            try:
+                repo = repositories.acquire(init_settings.base_path)
+            except GitError as ge:
+                raise HTTPException(404) from ge
+            try:
+                if repo.lookup_branch(branch_id) is None:
+                    raise HTTPException(404)
+                if init_settings.git.remote_name in list(repo.remotes.names()):
+                    await fetch_remote(repo, max_age=init_settings.git.fetch_max_age)
+                    if not local_delete and repo.branches[branch_id].upstream is not None:
+                        await run_blocking(
+                            repo.remotes[init_settings.git.remote_name].push,
+                            [f":refs/heads/{branch_id}"],
+                            callbacks=RemoteRepositoryCallbacks(),
+                        )
+                        await fetch_remote_refs(repo, [], [f"refs/heads/{branch_id}"])
+                await run_blocking(remove_branch_worktree, repo, branch_id)
+                repo.branches.delete(branch_id)
+                new_folders.pop(branch_id, None)
+                push_queue.discard(branch_id)
+            finally:
+                repositories.release(repo)
         await cron.insecure_track_branches()
@@ -12,14 +12,13 @@ from fastapi.exceptions import HTTPException
 from fastapi.responses import Response
 
 from uedition_editor.api.auth import get_current_user
-from uedition_editor.api.util import BranchContextManager, BranchNotFoundError
+from uedition_editor.api.util import BranchContextManager, BranchNotFoundError, branch_path
 from uedition_editor.settings import (
     TEINode,
     UEditionSettings,
     UEditorSettings,
     get_uedition_settings,
     get_ueditor_settings,
-    init_settings,
 )
 
 router = APIRouter(prefix="/configs")
@@ -34,8 +33,8 @@ async def uedition_config(
     """Fetch the uEdition configuration."""
     branch_id = branch_id.replace("%2F", "/")
     try:
-        async with BranchContextManager(branch_id):
-            settings = get_uedition_settings()
+        async with BranchContextManager(branch_id, write=False) as repo:
+            settings = get_uedition_settings(branch_path(repo))
             if "tei" in settings.sphinx_config:
                 if "blocks" in settings.sphinx_config["tei"]:
                     settings.sphinx_config["tei"]["blocks"] = [
@@ -58,8 +57,8 @@ async def tei_config(
     """Fetch the uEditor configuration."""
     branch_id = branch_id.replace("%2F", "/")
     try:
-        async with BranchContextManager(branch_id):
-            return get_ueditor_settings().model_dump()
+        async with BranchContextManager(branch_id, write=False) as repo:
+            return get_ueditor_settings(branch_path(repo)).model_dump()
     except BranchNotFoundError as bnfe:
         raise HTTPException(404) from bnfe
 
@@ -72,10 +71,11 @@ async def ui_stylesheet(
     """Fetch the configured CSS stylesheets."""
     branch_id = branch_id.replace("%2F", "/")
     try:
-        async with BranchContextManager(branch_id):
+        async with BranchContextManager(branch_id, write=False) as repo:
+            base_path = branch_path(repo)
             tmp = []
-            for filename in get_ueditor_settings().ui.css_files:
-                full_path = os.path.join(init_settings.base_path, filename)
+            for filename in get_ueditor_settings(base_path).ui.css_files:
+                full_path = os.path.join(base_path, filename)
                 if os.path.exists(full_path):
                     with open(full_path) as in_f:
                         tmp.append(in_f.read())
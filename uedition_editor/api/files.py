@@ -9,19 +9,24 @@ import mimetypes
 import os
 import re
 import shutil
+from collections.abc import Iterator
 from typing import Annotated
 
 import pygit2
-from fastapi import APIRouter, Depends, Header, Response, UploadFile
+from fastapi import APIRouter, Depends, Header, Query, Response, UploadFile
 from fastapi.exceptions import HTTPException
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, StreamingResponse
 from lxml import etree
 
 from uedition_editor.api.auth import get_current_user
 from uedition_editor.api.util import (
     BranchContextManager,
     BranchNotFoundError,
+    branch_commit,
+    branch_path,
     commit_and_push,
+    run_blocking,
+    worktree_path,
 )
 from uedition_editor.settings import (
     TEIMetadataSection,
@@ -35,6 +40,7 @@ from uedition_editor.settings import (
     get_ueditor_settings,
     init_settings,
 )
+from uedition_editor.state import file_tree_cache, git_file_tree_cache, new_folders, repositories
 
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/files")
@@ -53,6 +59,7 @@ MIMETYPE_EXTENSIONS = {
     ".yaml": "application/yaml",
     ".yml": "application/yaml",
 }
+BLOB_CHUNK_SIZE = 1024 * 1024
 
 
 def guess_type(url: str) -> tuple[str | None, str | None]:
@@ -69,58 +76,675 @@ def guess_type(url: str) -> tuple[str | None, str | None]:
         return ("application/unknown", None)
 
 
-def build_file_tree(path: str, strip_len: int, uedition_settings: UEditionSettings) -> list[dict]:
-    """Recursively build a tree of directories and files."""
+def ignore_pattern_regex(pattern: str) -> re.Pattern:
+    """Convert the .gitignore glob `pattern` into a regular expression that matches full paths."""
+    regex = ""
+    idx = 0
+    while idx < len(pattern):
+        if pattern.startswith("**/", idx):
+            regex += "(?:.*/)?"
+            idx += 3
+        elif pattern.startswith("/**", idx) and idx + 3 == len(pattern):
+            regex += "/.*"
+            idx += 3
+        elif pattern.startswith("**", idx):
+            regex += ".*"
+            idx += 2
+        elif pattern[idx] == "*":
+            regex += "[^/]*"
+            idx += 1
+        elif pattern[idx] == "?":
+            regex += "[^/]"
+            idx += 1
+        elif pattern[idx] == "[" and "]" in pattern[idx + 2 :]:
+            end_idx = pattern.index("]", idx + 2)
+            characters = pattern[idx + 1 : end_idx].replace("\\", "\\\\")
+            if characters.startswith("!"):
+                characters = f"^{characters[1:]}"
+            regex += f"[{characters}]"
+            idx = end_idx + 1
+        else:
+            regex += re.escape(pattern[idx])
+            idx += 1
+    return re.compile(regex)
+
+
+def parse_ignore_patterns(lines: list[str], prefix: str = "") -> list[tuple[bool, bool, re.Pattern]]:
+    """
+    Parse the `lines` of a .gitignore file in the folder `prefix` into patterns for `is_ignored`.
+
+    Each pattern consists of whether it is negated, whether it only matches folders, and the regular expression for
+    the full path. As in git, patterns without a "/" match files and folders at any level below the `prefix`.
+    """
+    patterns = []
+    for line in lines:
+        line = line.rstrip()  # noqa: PLW2901
+        if not line or line.startswith("#"):
+            continue
+        negated = line.startswith("!")
+        if negated or line.startswith("\\"):
+            line = line[1:]  # noqa: PLW2901
+        folder_only = line.endswith("/")
+        line = line.rstrip("/")  # noqa: PLW2901
+        if "/" not in line:
+            line = f"**/{line}"  # noqa: PLW2901
+        patterns.append((negated, folder_only, ignore_pattern_regex(f"{prefix}{line.lstrip('/')}")))
+    return patterns
+
+
+def is_ignored(fullpath: str, is_folder: bool, patterns: list[tuple[bool, bool, re.Pattern]]) -> bool:  # noqa: FBT001
+    """Check whether the file or folder at `fullpath` is ignored by the `patterns`, of which the last match wins."""
+    ignored = False
+    for negated, folder_only, regex in patterns:
+        if (is_folder or not folder_only) and regex.fullmatch(fullpath):
+            ignored = not negated
+    return ignored
+
+
+def exclude_patterns(uedition_settings: UEditionSettings, ueditor_settings: UEditorSettings) -> list[str]:
+    """Return the patterns of the files and folders that are never shown in the tree of files."""
+    return [".git/", "/_build/", f"/{uedition_settings.output.path}/", *ueditor_settings.exclude]
+
+
+def build_file_tree(
+    path: str,
+    strip_len: int,
+    exclude: list[tuple[bool, bool, re.Pattern]],
+    ignore: list[tuple[bool, bool, re.Pattern]] | None = None,
+    paths: dict[str, int] | None = None,
+) -> list[dict]:
+    """
+    Recursively build a tree of directories and files.
+
+    Files and folders that match the `exclude` patterns or the patterns of the .gitignore files are skipped and ignored
+    folders are not read. If `paths` is given, then the modification time of each folder and .gitignore file that is
+    read is recorded in it.
+    """
     files = []
-    for filename in os.listdir(path):
+    if paths is not None:
+        paths[path] = os.stat(path).st_mtime_ns
+    filenames = os.listdir(path)
+    ignore = list(ignore or [])
+    if ".gitignore" in filenames:
+        gitignore_path = os.path.join(path, ".gitignore")
+        with open(gitignore_path) as in_f:
+            ignore.extend(parse_ignore_patterns(in_f.readlines(), f"{path[strip_len:]}/" if path[strip_len:] else ""))
+        if paths is not None:
+            paths[gitignore_path] = os.stat(gitignore_path).st_mtime_ns
+    for filename in filenames:
         full_filename = os.path.join(path, filename)
+        fullpath = full_filename[strip_len:]
         if os.path.isdir(full_filename):
-            if filename != ".git" and full_filename[strip_len:] not in (
-                uedition_settings.output.path,
-                "_build",
-            ):
+            if not is_ignored(fullpath, True, exclude) and not is_ignored(fullpath, True, ignore):
                 files.append(
                     {
                         "name": filename,
-                        "fullpath": full_filename[strip_len:],
+                        "fullpath": fullpath,
                         "type": "folder",
-                        "content": build_file_tree(full_filename, strip_len, uedition_settings),
+                        "content": build_file_tree(full_filename, strip_len, exclude, ignore, paths),
                         "mimetype": "application/folder",
                     }
                 )
         elif os.path.isfile(full_filename):
-            mimetype = guess_type(filename)
-            files.append(
-                {
-                    "name": filename,
-                    "fullpath": full_filename[strip_len:],
-                    "type": "file",
-                    "mimetype": mimetype[0],
-                }
-            )
+            if not is_ignored(fullpath, False, exclude) and not is_ignored(fullpath, False, ignore):
+                mimetype = guess_type(filename)
+                files.append(
+                    {
+                        "name": filename,
+                        "fullpath": fullpath,
+                        "type": "file",
+                        "mimetype": mimetype[0],
+                    }
+                )
     files.sort(key=lambda entry: (0 if entry["type"] == "folder" else 1, entry["name"]))
     return files
 
 
-@router.get("/")
+def paths_unchanged(paths: dict[str, int]) -> bool:
+    """Check whether none of the `paths` have been modified since their modification times were recorded."""
+    try:
+        return all(os.stat(path).st_mtime_ns == mtime for path, mtime in paths.items())
+    except OSError:
+        return False
+
+
+def cached_file_tree(branch_id: str, path: str) -> list[dict]:
+    """
+    Fetch the tree of files for the branch from the filesystem at `path`.
+
+    The tree is cached until a file or folder is added, removed, or renamed in any of its folders, which changes the
+    modification time of that folder, or until the settings or .gitignore files are changed.
+    """
+    if branch_id in file_tree_cache and paths_unchanged(file_tree_cache[branch_id][0]):
+        return file_tree_cache[branch_id][1]
+    paths = {}
+    for filename in ("uEdition.yml", "uEdition.yaml", "uEditor.yml", "uEditor.yaml"):
+        if os.path.isfile(os.path.join(path, filename)):
+            paths[os.path.join(path, filename)] = os.stat(os.path.join(path, filename)).st_mtime_ns
+    exclude = parse_ignore_patterns(exclude_patterns(get_uedition_settings(path), get_ueditor_settings(path)))
+    files = build_file_tree(path, len(path) + 1, exclude, paths=paths)
+    file_tree_cache[branch_id] = (paths, files)
+    return files
+
+
+def build_git_file_tree(
+    tree: pygit2.Tree,
+    prefix: str,
+    exclude: list[tuple[bool, bool, re.Pattern]],
+    folders: dict[tuple[str, str], list[dict]] | None = None,
+    previous: dict[tuple[str, str], list[dict]] | None = None,
+) -> list[dict]:
+    """
+    Recursively build a tree of directories and files from a git tree.
+
+    Files and folders that match the `exclude` patterns are skipped. If `folders` is given, then the content of each
+    folder is recorded in it. If `previous` is given, then the content of folders that were recorded in it is reused,
+    instead of being built again.
+    """
+    files = []
+    for obj in tree:
+        full_filename = f"{prefix}{obj.name}"
+        if isinstance(obj, pygit2.Tree):
+            if not is_ignored(full_filename, True, exclude):
+                key = (full_filename, str(obj.id))
+                if previous is not None and key in previous:
+                    content = previous[key]
+                else:
+                    content = build_git_file_tree(obj, f"{full_filename}/", exclude, folders, previous)
+                if folders is not None:
+                    folders[key] = content
+                files.append(
+                    {
+                        "name": obj.name,
+                        "fullpath": full_filename,
+                        "type": "folder",
+                        "content": content,
+                        "mimetype": "application/folder",
+                    }
+                )
+        elif isinstance(obj, pygit2.Blob):
+            if not is_ignored(full_filename, False, exclude):
+                mimetype = guess_type(obj.name)
+                files.append(
+                    {
+                        "name": obj.name,
+                        "fullpath": full_filename,
+                        "type": "file",
+                        "mimetype": mimetype[0],
+                    }
+                )
+    files.sort(key=lambda entry: (0 if entry["type"] == "folder" else 1, entry["name"]))
+    return files
+
+
+def cached_git_file_tree(branch_id: str, commit: pygit2.Commit) -> list[dict]:
+    """
+    Fetch the tree of files for the `commit` of the branch.
+
+    The tree is cached by the commit's tree id. When it changes, only the folders whose trees have changed are built
+    again, unless the excluded files have changed.
+    """
+    tree_id = str(commit.tree_id)
+    if branch_id in git_file_tree_cache and git_file_tree_cache[branch_id][0] == tree_id:
+        return git_file_tree_cache[branch_id][2]
+    previous = None
+    exclude = exclude_patterns(get_uedition_settings(commit), get_ueditor_settings(commit))
+    if branch_id in git_file_tree_cache and git_file_tree_cache[branch_id][1] == exclude:
+        previous = git_file_tree_cache[branch_id][3]
+    folders = {}
+    files = build_git_file_tree(commit.tree, "", parse_ignore_patterns(exclude), folders, previous)
+    git_file_tree_cache[branch_id] = (tree_id, exclude, files, folders)
+    return files
+
+
+def add_new_folder(files: list[dict], path: str) -> None:
+    """
+    Add the folder `path`, which is not tracked by git, to the tree of `files`.
+
+    The folders along the `path` are copied before they are changed, so that a cached tree is never modified.
+    """
+    fullpath = ""
+    for name in path.split("/"):
+        fullpath = f"{fullpath}/{name}" if fullpath else name
+        for idx, entry in enumerate(files):
+            if entry["type"] == "folder" and entry["name"] == name:
+                entry = {**entry, "content": list(entry["content"])}  # noqa: PLW2901
+                files[idx] = entry
+                break
+        else:
+            entry = {
+                "name": name,
+                "fullpath": fullpath,
+                "type": "folder",
+                "content": [],
+                "mimetype": "application/folder",
+            }
+            files.append(entry)
+            files.sort(key=lambda entry: (0 if entry["type"] == "folder" else 1, entry["name"]))
+        files = entry["content"]
+
+
+def find_new_folders(repo: pygit2.Repository, tree: pygit2.Tree) -> set[str]:
+    """Find the folders in the working tree of the `repo` that are not in the `tree` and are not ignored."""
+    folders = set()
+    for dirpath, dirnames, _ in os.walk(repo.workdir):
+        prefix = os.path.relpath(dirpath, repo.workdir).replace(os.sep, "/")
+        prefix = "" if prefix == "." else f"{prefix}/"
+        for dirname in list(dirnames):
+            fullpath = f"{prefix}{dirname}"
+            if dirname == ".git" or repo.path_is_ignored(f"{fullpath}/"):
+                dirnames.remove(dirname)
+            elif fullpath not in tree:
+                folders.add(fullpath)
+    return folders
+
+
+def branch_new_folders(branch_id: str) -> set[str]:
+    """
+    Return the new folders of the branch, which are not tracked by git.
+
+    The first time this is called for a branch, the new folders are found in the branch's working tree, so that they
+    are still known after a restart.
+    """
+    if branch_id not in new_folders:
+        folders = set()
+        with repositories.repository(init_settings.base_path) as repo:
+            branch = repo.lookup_branch(branch_id)
+            path = repo.workdir if branch_id == init_settings.git.default_branch else worktree_path(repo, branch_id)
+            if branch is not None and os.path.isdir(path):
+                with repositories.repository(path) as branch_repo:
+                    folders = find_new_folders(branch_repo, branch.peel(pygit2.Commit).tree)
+        new_folders.setdefault(branch_id, folders)
+    return new_folders[branch_id]
+
+
+def update_new_folders(branch_id: str, path: str, new_path: str | None = None) -> None:
+    """Remove or rename the new folders at or below the `path`."""
+    folders = new_folders.get(branch_id, set())
+    for folder in list(folders):
+        if folder == path or folder.startswith(f"{path}/"):
+            folders.discard(folder)
+            if new_path is not None:
+                folders.add(f"{new_path}{folder[len(path) :]}")
+
+
+def read_ignore_patterns(path: str, strip_len: int) -> list[tuple[bool, bool, re.Pattern]]:
+    """Read the patterns of the .gitignore file in the folder at `path`, if there is one."""
+    try:
+        with open(os.path.join(path, ".gitignore")) as in_f:
+            return parse_ignore_patterns(in_f.readlines(), f"{path[strip_len:]}/" if path[strip_len:] else "")
+    except OSError:
+        return []
+
+
+def scan_folder(
+    path: str,
+    strip_len: int,
+    exclude: list[tuple[bool, bool, re.Pattern]],
+    ignore: list[tuple[bool, bool, re.Pattern]],
+) -> tuple[list[os.DirEntry], list[tuple[bool, bool, re.Pattern]]]:
+    """
+    Scan the folder at `path` for the files and folders that are not excluded or ignored.
+
+    Returns the sorted entries and the ignore patterns that apply to the folder's content. A folder that no longer
+    exists, because it was removed while its parent was streamed, has no entries.
+    """
+    ignore = ignore + read_ignore_patterns(path, strip_len)
+    entries = []
+    try:
+        with os.scandir(path) as scanner:
+            for entry in scanner:
+                is_folder = entry.is_dir()
+                if (is_folder or entry.is_file()) and not (
+                    is_ignored(entry.path[strip_len:], is_folder, exclude)
+                    or is_ignored(entry.path[strip_len:], is_folder, ignore)
+                ):
+                    entries.append(entry)
+    except (FileNotFoundError, NotADirectoryError):
+        return [], ignore
+    entries.sort(key=lambda entry: (0 if entry.is_dir() else 1, entry.name))
+    return entries, ignore
+
+
+def stream_file_tree(
+    path: str,
+    strip_len: int,
+    exclude: list[tuple[bool, bool, re.Pattern]],
+    ignore: list[tuple[bool, bool, re.Pattern]],
+    depth: int | None = None,
+) -> Iterator[dict]:
+    """
+    Recursively yield the directories and files below the `path`, each folder being followed by its content.
+
+    Only `depth` levels are yielded and folders at the last level contain the number of their entries as `children`.
+    """
+    entries, ignore = scan_folder(path, strip_len, exclude, ignore)
+    for entry in entries:
+        if entry.is_dir():
+            folder = {
+                "name": entry.name,
+                "fullpath": entry.path[strip_len:],
+                "type": "folder",
+                "mimetype": "application/folder",
+            }
+            if depth is not None and depth <= 1:
+                folder["children"] = len(scan_folder(entry.path, strip_len, exclude, ignore)[0])
+                yield folder
+            else:
+                yield folder
+                yield from stream_file_tree(
+                    entry.path, strip_len, exclude, ignore, depth - 1 if depth is not None else None
+                )
+        else:
+            yield {
+                "name": entry.name,
+                "fullpath": entry.path[strip_len:],
+                "type": "file",
+                "mimetype": guess_type(entry.name)[0],
+            }
+
+
+def stream_files(base_path: str, path: str, depth: int | None) -> Iterator[str]:
+    """Stream the tree of files below the `path` in the folder at `base_path` as lines of JSON."""
+    strip_len = len(base_path) + 1
+    exclude = parse_ignore_patterns(exclude_patterns(get_uedition_settings(base_path), get_ueditor_settings(base_path)))
+    ignore = []
+    folder_path = base_path
+    for name in path.split("/") if path else []:
+        ignore.extend(read_ignore_patterns(folder_path, strip_len))
+        folder_path = os.path.join(folder_path, name)
+    for entry in stream_file_tree(folder_path, strip_len, exclude, ignore, depth):
+        yield f"{json.dumps(entry)}\n"
+
+
+def scan_git_folder(
+    tree: pygit2.Tree, prefix: str, exclude: list[tuple[bool, bool, re.Pattern]]
+) -> list[pygit2.Object]:
+    """Return the sorted files and folders in the `tree` that are not excluded."""
+    entries = [
+        obj
+        for obj in tree
+        if isinstance(obj, pygit2.Tree | pygit2.Blob)
+        and not is_ignored(f"{prefix}{obj.name}", isinstance(obj, pygit2.Tree), exclude)
+    ]
+    entries.sort(key=lambda obj: (0 if isinstance(obj, pygit2.Tree) else 1, obj.name))
+    return entries
+
+
+def stream_git_file_tree(
+    tree: pygit2.Tree, prefix: str, exclude: list[tuple[bool, bool, re.Pattern]], depth: int | None = None
+) -> Iterator[dict]:
+    """
+    Recursively yield the directories and files in the git `tree`, each folder being followed by its content.
+
+    Only `depth` levels are yielded and folders at the last level contain the number of their entries as `children`.
+    """
+    for obj in scan_git_folder(tree, prefix, exclude):
+        full_filename = f"{prefix}{obj.name}"
+        if isinstance(obj, pygit2.Tree):
+            folder = {
+                "name": obj.name,
+                "fullpath": full_filename,
+                "type": "folder",
+                "mimetype": "application/folder",
+            }
+            if depth is not None and depth <= 1:
+                folder["children"] = len(scan_git_folder(obj, f"{full_filename}/", exclude))
+                yield folder
+            else:
+                yield folder
+                yield from stream_git_file_tree(
+                    obj, f"{full_filename}/", exclude, depth - 1 if depth is not None else None
+                )
+        else:
+            yield {
+                "name": obj.name,
+                "fullpath": full_filename,
+                "type": "file",
+                "mimetype": guess_type(obj.name)[0],
+            }
+
+
+def stream_git_files(branch_id: str, commit_id: str, path: str, depth: int | None) -> Iterator[str]:
+    """
+    Stream the tree of files of the commit `commit_id` of the branch below the `path` as lines of JSON.
+
+    New folders that are not tracked by git follow the tracked files and folders. The `path` must be a tracked folder or
+    one of the new folders.
+    """
+    with repositories.repository(init_settings.base_path) as repo:
+        commit = repo.get(commit_id)
+        exclude = parse_ignore_patterns(exclude_patterns(get_uedition_settings(commit), get_ueditor_settings(commit)))
+        tree = None
+        if not path:
+            tree = commit.tree
+        elif path in commit.tree:
+            tree = commit.tree[path]
+        if isinstance(tree, pygit2.Tree):
+            for entry in stream_git_file_tree(tree, f"{path}/" if path else "", exclude, depth):
+                yield f"{json.dumps(entry)}\n"
+        streamed = set()
+        for folder in sorted(new_folders.get(branch_id, set())):
+            fullpath = ""
+            for name in folder.split("/"):
+                fullpath = f"{fullpath}/{name}" if fullpath else name
+                if (
+                    fullpath.startswith(f"{path}/" if path else "")
+                    and (depth is None or fullpath[len(path) :].strip("/").count("/") < depth)
+                    and fullpath not in commit.tree
+                    and fullpath not in streamed
+                ):
+                    streamed.add(fullpath)
+                    entry = {"name": name, "fullpath": fullpath, "type": "folder", "mimetype": "application/folder"}
+                    yield f"{json.dumps(entry)}\n"
+
+
+def is_excluded(fullpath: str, is_folder: bool, exclude: list[tuple[bool, bool, re.Pattern]]) -> bool:  # noqa: FBT001
+    """Check whether the file or folder at `fullpath` or any of the folders it is in is excluded."""
+    parts = fullpath.split("/")
+    return any(is_ignored("/".join(parts[:idx]), True, exclude) for idx in range(1, len(parts))) or is_ignored(
+        fullpath, is_folder, exclude
+    )
+
+
+def tree_entry(fullpath: str, is_folder: bool) -> dict:  # noqa: FBT001
+    """Create the entry in the tree of files for the file or folder at `fullpath`."""
+    name = fullpath.split("/")[-1]
+    if is_folder:
+        return {"name": name, "fullpath": fullpath, "type": "folder", "mimetype": "application/folder"}
+    return {"name": name, "fullpath": fullpath, "type": "file", "mimetype": guess_type(name)[0]}
+
+
+def missing_folders(fullpath: str, tree: pygit2.Tree, other_tree: pygit2.Tree) -> list[str]:
+    """Return the folders along the `fullpath` that are in the `tree`, but not in the `other_tree`."""
+    parts = fullpath.split("/")
+    return [
+        "/".join(parts[:idx])
+        for idx in range(1, len(parts))
+        if "/".join(parts[:idx]) in tree and "/".join(parts[:idx]) not in other_tree
+    ]
+
+
+def git_file_tree_delta(commit: pygit2.Commit, since: str) -> dict:
+    """
+    Compute the files and folders that have changed between the tree `since` and the tree of the `commit`.
+
+    Only files and folders that have been added, removed, or renamed are returned. Folders are added or removed if
+    they only exist in one of the two trees. Renames are only detected for files.
+    """
+    with repositories.repository(init_settings.base_path) as repo:
+        try:
+            old_tree = repo.get(since)
+        except ValueError:
+            old_tree = None
+        if not isinstance(old_tree, pygit2.Tree):
+            raise HTTPException(
+                422,
+                detail=[{"loc": ["query", "since"], "msg": "this tree does not exist"}],
+            )
+        new_tree = commit.tree
+        exclude = parse_ignore_patterns(exclude_patterns(get_uedition_settings(commit), get_ueditor_settings(commit)))
+        diff = old_tree.diff_to_tree(new_tree)
+        diff.find_similar()
+        added = {}
+        removed = {}
+        renamed = []
+        for delta in diff.deltas:
+            old_path = delta.old_file.path
+            new_path = delta.new_file.path
+            if delta.status in (pygit2.enums.DeltaStatus.DELETED, pygit2.enums.DeltaStatus.RENAMED):
+                removed.update(dict.fromkeys(missing_folders(old_path, old_tree, new_tree), True))
+            if delta.status in (pygit2.enums.DeltaStatus.ADDED, pygit2.enums.DeltaStatus.RENAMED):
+                added.update(dict.fromkeys(missing_folders(new_path, new_tree, old_tree), True))
+            if delta.status == pygit2.enums.DeltaStatus.RENAMED and not is_excluded(old_path, False, exclude):
+                if is_excluded(new_path, False, exclude):
+                    removed[old_path] = False
+                else:
+                    renamed.append({"from": old_path, "to": tree_entry(new_path, False)})
+            elif delta.status == pygit2.enums.DeltaStatus.DELETED:
+                removed[old_path] = False
+            elif delta.status in (pygit2.enums.DeltaStatus.ADDED, pygit2.enums.DeltaStatus.RENAMED):
+                added[new_path] = False
+        return {
+            "tree": str(new_tree.id),
+            "added": [
+                tree_entry(fullpath, is_folder)
+                for fullpath, is_folder in sorted(added.items())
+                if not is_excluded(fullpath, is_folder, exclude)
+            ],
+            "removed": [
+                fullpath
+                for fullpath, is_folder in sorted(removed.items())
+                if not is_excluded(fullpath, is_folder, exclude)
+            ],
+            "renamed": sorted(renamed, key=lambda rename: rename["from"]),
+        }
+
+
+def limit_file_tree(files: list[dict], depth: int | None) -> list[dict]:
+    """
+    Limit the tree of `files` to `depth` levels.
+
+    The content of folders below the `depth` is replaced with the number of entries in the folder as `children`.
+    """
+    if depth is None:
+        return files
+    result = []
+    for entry in files:
+        if entry["type"] == "folder" and depth > 1:
+            result.append({**entry, "content": limit_file_tree(entry["content"], depth - 1)})
+        elif entry["type"] == "folder":
+            folder = {key: value for key, value in entry.items() if key != "content"}
+            folder["children"] = len(entry["content"])
+            result.append(folder)
+        else:
+            result.append(entry)
+    return result
+
+
+def find_folder(folder: dict, path: str) -> dict | None:
+    """Find the folder at the `path` below the `folder`."""
+    for name in path.split("/"):
+        for entry in folder["content"]:
+            if entry["type"] == "folder" and entry["name"] == name:
+                folder = entry
+                break
+        else:
+            return None
+    return folder
+
+
+def is_git_folder(commit: pygit2.Commit, branch_id: str, path: str) -> bool:
+    """Check whether the `path` is a folder in the `commit` or one of the new folders of the branch."""
+    if not path or (path in commit.tree and isinstance(commit.tree[path], pygit2.Tree)):
+        return True
+    return any(folder == path or folder.startswith(f"{path}/") for folder in new_folders.get(branch_id, set()))
+
+
+@router.get("/", response_model=None)
 async def get_files(
     branch_id: str,
     current_user: Annotated[dict, Depends(get_current_user)],  # noqa:ARG001
-) -> list[dict]:
-    """Fetch the full tree of files."""
+    response: Response,
+    path: str = "",
+    depth: Annotated[int | None, Query(ge=1)] = None,
+    since: str | None = None,
+    accept: Annotated[str, Header()] = "application/json",
+) -> list[dict] | dict | StreamingResponse:
+    """
+    Fetch the tree of files.
+
+    If a `path` is given, then only the tree below that folder is returned. If a `depth` is given, then only that many
+    levels of the tree are returned and folders below that level contain the number of their entries as `children`.
+
+    If git is used, then the tree is read from the latest commit of the branch, without acquiring the branch lock.
+    Trees are cached per branch until the branch's files change.
+
+    If the "application/x-ndjson" type is accepted, then the files and folders are streamed as one JSON object per line
+    instead, each folder being followed by its content. The streamed tree is not cached. Without git, the files are
+    streamed after the branch lock has been released, so folders removed in the meantime are streamed without content.
+
+    If git is used, then the id of the branch's tree is returned in the "X-uEditor-Tree" header. Passing that id as
+    `since` returns only the files and folders that have been added, removed, or renamed since then. New folders that
+    are not tracked by git are not part of the tree. The changes always cover the whole tree, so `since` cannot be
+    combined with a `path` or `depth`.
+    """
     branch_id = branch_id.replace("%2F", "/")
+    path = path.strip("/")
     try:
-        async with BranchContextManager(branch_id):
-            full_path = os.path.abspath(init_settings.base_path)
-            return [
-                {
-                    "name": "/",
-                    "fullpath": "",
-                    "type": "folder",
-                    "mimetype": "application/folder",
-                    "content": build_file_tree(full_path, len(full_path) + 1, get_uedition_settings()),
-                }
-            ]
+        with branch_commit(branch_id) as commit:
+            if commit is not None:
+                response.headers["X-uEditor-Tree"] = str(commit.tree_id)
+                if since is not None:
+                    if path or depth is not None:
+                        raise HTTPException(
+                            422,
+                            detail=[
+                                {
+                                    "loc": ["query", "since"],
+                                    "msg": "changes can only be tracked for the whole tree, without a path or depth",
+                                }
+                            ],
+                        )
+                    return await run_blocking(git_file_tree_delta, commit, since)
+                if "application/x-ndjson" in accept:
+                    await run_blocking(branch_new_folders, branch_id)
+                    if not is_git_folder(commit, branch_id, path):
+                        raise HTTPException(404)
+                    return StreamingResponse(
+                        stream_git_files(branch_id, str(commit.id), path, depth),
+                        headers={"X-uEditor-Tree": str(commit.tree_id)},
+                        media_type="application/x-ndjson",
+                    )
+                files = list(await run_blocking(cached_git_file_tree, branch_id, commit))
+                for folder in sorted(await run_blocking(branch_new_folders, branch_id)):
+                    add_new_folder(files, folder)
+        if commit is None:
+            if since is not None:
+                raise HTTPException(
+                    422,
+                    detail=[{"loc": ["query", "since"], "msg": "changes can only be tracked with git"}],
+                )
+            async with BranchContextManager(branch_id, write=False) as repo:
+                base_path = os.path.abspath(branch_path(repo))
+                if "application/x-ndjson" in accept:
+                    full_path = os.path.abspath(os.path.join(base_path, *path.split("/")))
+                    if not full_path.startswith(base_path) or not os.path.isdir(full_path):
+                        raise HTTPException(404)
+                    return StreamingResponse(stream_files(base_path, path, depth), media_type="application/x-ndjson")
+                files = await run_blocking(cached_file_tree, branch_id, base_path)
+        folder = {
+            "name": "/",
+            "fullpath": "",
+            "type": "folder",
+            "mimetype": "application/folder",
+            "content": files,
+        }
+        if path:
+            folder = find_folder(folder, path)
+            if folder is None:
+                raise HTTPException(404)
+        return [{**folder, "content": limit_file_tree(folder["content"], depth)}]
     except BranchNotFoundError as bnfe:
         raise HTTPException(404) from bnfe
 
@@ -237,8 +861,14 @@ def clean_tei_subdoc(node: dict) -> dict:
 
 def parse_tei_file(path: str, settings: UEditorSettings) -> list[dict]:
     """Parse a TEI file into its constituent parts."""
+    with open(path, "rb") as in_f:
+        return parse_tei(in_f.read(), settings)
+
+
+def parse_tei(data: bytes, settings: UEditorSettings) -> list[dict]:
+    """Parse the TEI document `data` into its constituent parts."""
     try:
-        doc = etree.parse(path)  # noqa: S320
+        doc = etree.fromstring(data)  # noqa: S320
         result = []
         for section in settings.tei.sections:
             section_root = doc.xpath(section.selector, namespaces=namespaces)
@@ -308,11 +938,7 @@ def parse_tei_file(path: str, settings: UEditorSettings) -> list[dict]:
                     )
         return result
     except etree.XMLSyntaxError as e:
-        is_empty = False
-        with open(path) as in_f:
-            if in_f.read() == "":
-                is_empty = True
-        if is_empty:
+        if data == b"":
             result = []
             for section in settings.tei.sections:
                 if section.type == "metadata":
@@ -347,33 +973,72 @@ def parse_tei_file(path: str, settings: UEditorSettings) -> list[dict]:
             raise e
 
 
+def get_tei_settings(source: str | pygit2.Commit) -> UEditorSettings:
+    """Load the UEditorSettings, including the TEI blocks and marks configured in the uEdition settings."""
+    ueditor_settings = get_ueditor_settings(source)
+    uedition_settings = get_uedition_settings(source)
+    if "tei" in uedition_settings.sphinx_config:
+        if "blocks" in uedition_settings.sphinx_config["tei"]:
+            ueditor_settings.tei.blocks.extend(
+                [TEINode(**block) for block in uedition_settings.sphinx_config["tei"]["blocks"]]
+            )
+        if "marks" in uedition_settings.sphinx_config["tei"]:
+            ueditor_settings.tei.marks.extend(
+                [TEINode(**mark) for mark in uedition_settings.sphinx_config["tei"]["marks"]]
+            )
+    return ueditor_settings
+
+
+def stream_blob(blob_id: str) -> Iterator[bytes]:
+    """Stream the content of the blob `blob_id` in chunks of `BLOB_CHUNK_SIZE`."""
+    with repositories.repository(init_settings.base_path) as repo, pygit2.BlobIO(repo.get(blob_id)) as in_f:
+        while chunk := in_f.read(BLOB_CHUNK_SIZE):
+            yield chunk
+
+
 @router.get("/{path:path}", response_model=None)
 async def get_file(
     branch_id: str,
     path: str,
     current_user: Annotated[dict, Depends(get_current_user)],  # noqa:ARG001
     response: Response,
-) -> dict | FileResponse:
-    """Fetch a single file from the repo."""
+) -> dict | Response:
+    """
+    Fetch a single file from the repo.
+
+    If git is used, then the file is read from the latest commit of the branch, without acquiring the branch lock. Files
+    larger than `BLOB_CHUNK_SIZE` are streamed in chunks of that size.
+    """
     branch_id = branch_id.replace("%2F", "/")
     try:
-        async with BranchContextManager(branch_id):
-            ueditor_settings = get_ueditor_settings()
-            uedition_settings = get_uedition_settings()
-            full_path = os.path.abspath(os.path.join(init_settings.base_path, *path.split("/")))
-            if full_path.startswith(os.path.abspath(init_settings.base_path)) and os.path.isfile(full_path):
+        with branch_commit(branch_id) as commit:
+            if commit is not None:
+                try:
+                    obj = commit.tree[path.strip("/")]
+                except KeyError as ke:
+                    raise HTTPException(404) from ke
+                if not isinstance(obj, pygit2.Blob):
+                    raise HTTPException(404)
+                if not path.endswith(".tei"):
+                    if obj.size <= BLOB_CHUNK_SIZE:
+                        return Response(content=obj.data, media_type=guess_type(path)[0])
+                    return StreamingResponse(
+                        stream_blob(str(obj.id)),
+                        headers={"Content-Length": str(obj.size)},
+                        media_type=guess_type(path)[0],
+                    )
+                data = obj.data
+                settings = get_tei_settings(commit)
+        if commit is not None:
+            response.headers["Content-Type"] = "application/json+tei"
+            return await run_blocking(parse_tei, data, settings)
+        async with BranchContextManager(branch_id, write=False) as repo:
+            base_path = branch_path(repo)
+            full_path = os.path.abspath(os.path.join(base_path, *path.split("/")))
+            if full_path.startswith(os.path.abspath(base_path)) and os.path.isfile(full_path):
                 if full_path.endswith(".tei"):
-                    if "tei" in uedition_settings.sphinx_config:
-                        if "blocks" in uedition_settings.sphinx_config["tei"]:
-                            ueditor_settings.tei.blocks.extend(
-                                [TEINode(**block) for block in uedition_settings.sphinx_config["tei"]["blocks"]]
-                            )
-                        if "marks" in uedition_settings.sphinx_config["tei"]:
-                            ueditor_settings.tei.marks.extend(
-                                [TEINode(**mark) for mark in uedition_settings.sphinx_config["tei"]["marks"]]
-                            )
                     response.headers["Content-Type"] = "application/json+tei"
-                    return parse_tei_file(full_path, ueditor_settings)
+                    return await run_blocking(parse_tei_file, full_path, get_tei_settings(base_path))
                 else:
                     return FileResponse(full_path, media_type=guess_type(full_path)[0])
             raise HTTPException(404)
@@ -404,13 +1069,12 @@ async def create_file(
             )
         async with BranchContextManager(branch_id) as repo:
             if new_type in ("file", "folder"):
-                full_path = os.path.abspath(os.path.join(init_settings.base_path, *path.split("/")))
-                if full_path.startswith(os.path.abspath(init_settings.base_path)) and not os.path.exists(full_path):
+                base_path = branch_path(repo)
+                full_path = os.path.abspath(os.path.join(base_path, *path.split("/")))
+                if full_path.startswith(os.path.abspath(base_path)) and not os.path.exists(full_path):
                     if rename_from is not None:
-                        rename_source_path = os.path.abspath(
-                            os.path.join(init_settings.base_path, *rename_from.split("/"))
-                        )
-                        if rename_source_path.startswith(os.path.abspath(init_settings.base_path)) and os.path.exists(
+                        rename_source_path = os.path.abspath(os.path.join(base_path, *rename_from.split("/")))
+                        if rename_source_path.startswith(os.path.abspath(base_path)) and os.path.exists(
                             rename_source_path
                         ):
                             try:
@@ -418,12 +1082,15 @@ async def create_file(
                                 if path.startswith("/"):
                                     path = path[1:]
                                 if repo is not None:
-                                    commit_and_push(
+                                    update_new_folders(branch_id, rename_from.strip("/"), path.strip("/"))
+                                    await run_blocking(
+                                        commit_and_push,
                                         repo,
                                         init_settings.git.remote_name,
                                         branch_id,
                                         f"Renamed {path}",
                                         pygit2.Signature(current_user["name"], current_user["sub"]),
+                                        paths=[rename_from, path],
                                     )
                                 return
                             except OSError as err:
@@ -448,16 +1115,20 @@ async def create_file(
                             if path.startswith("/"):
                                 path = path[1:]
                             if repo is not None:
-                                commit_and_push(
+                                await run_blocking(
+                                    commit_and_push,
                                     repo,
                                     init_settings.git.remote_name,
                                     branch_id,
                                     f"Added {path}",
                                     pygit2.Signature(current_user["name"], current_user["sub"]),
+                                    paths=[path],
                                 )
                             return
                         elif new_type == "folder":
                             os.makedirs(full_path)
+                            if repo is not None:
+                                (await run_blocking(branch_new_folders, branch_id)).add(path.strip("/"))
                             return
                 else:
                     raise HTTPException(
@@ -747,6 +1418,21 @@ def serialise_tei_file(
     return xml_dict_to_etree(root)
 
 
+def write_tei_file(path: str, json_doc: list, settings: UEditorSettings) -> None:
+    """Serialise the `json_doc` and write it to the TEI file at `path`."""
+    root = serialise_tei_file(path, json_doc, settings)
+    with open(path, "wb") as out_f:
+        out_f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
+        out_f.write(
+            etree.tostring(
+                root,
+                encoding="utf-8",
+                xml_declaration=False,
+                pretty_print=True,
+            )
+        )
+
+
 @router.put("/{path:path}", status_code=204)
 async def update_file(
     branch_id: str,
@@ -768,41 +1454,23 @@ async def update_file(
                 ],
             )
         async with BranchContextManager(branch_id) as repo:
-            ueditor_settings = get_ueditor_settings()
-            full_path = os.path.abspath(os.path.join(init_settings.base_path, *path.split("/")))
-            if full_path.startswith(os.path.abspath(init_settings.base_path)) and os.path.isfile(full_path):
+            base_path = branch_path(repo)
+            full_path = os.path.abspath(os.path.join(base_path, *path.split("/")))
+            if full_path.startswith(os.path.abspath(base_path)) and os.path.isfile(full_path):
                 if full_path.endswith(".tei"):
-                    uedition_settings = get_uedition_settings()
-                    if "tei" in uedition_settings.sphinx_config:
-                        if "blocks" in uedition_settings.sphinx_config["tei"]:
-                            ueditor_settings.tei.blocks.extend(
-                                [TEINode(**block) for block in uedition_settings.sphinx_config["tei"]["blocks"]]
-                            )
-                        if "marks" in uedition_settings.sphinx_config["tei"]:
-                            ueditor_settings.tei.marks.extend(
-                                [TEINode(**mark) for mark in uedition_settings.sphinx_config["tei"]["marks"]]
-                            )
-                    root = serialise_tei_file(full_path, json.load(content.file), ueditor_settings)
-                    with open(full_path, "wb") as out_f:
-                        out_f.write(b'<?xml version="1.0" encoding="UTF-8"?>\n')
-                        out_f.write(
-                            etree.tostring(
-                                root,
-                                encoding="utf-8",
-                                xml_declaration=False,
-                                pretty_print=True,
-                            )
-                        )
+                    await run_blocking(write_tei_file, full_path, json.load(content.file), get_tei_settings(base_path))
                 else:
                     with open(full_path, "wb") as out_f:
                         out_f.write(await content.read())
                 if repo is not None:
-                    commit_and_push(
+                    await run_blocking(
+                        commit_and_push,
                         repo,
                         init_settings.git.remote_name,
                         branch_id,
                         f"Updated {path}",
                         pygit2.Signature(current_user["name"], current_user["sub"]),
+                        paths=[path],
                     )
             else:
                 raise HTTPException(
@@ -838,8 +1506,9 @@ async def delete_file(
                 ],
             )
         async with BranchContextManager(branch_id) as repo:
-            full_path = os.path.abspath(os.path.join(init_settings.base_path, *path.split("/")))
-            if full_path.startswith(os.path.abspath(init_settings.base_path)):
+            base_path = branch_path(repo)
+            full_path = os.path.abspath(os.path.join(base_path, *path.split("/")))
+            if full_path.startswith(os.path.abspath(base_path)):
                 if os.path.isfile(full_path):
                     os.unlink(full_path)
                 elif os.path.isdir(full_path):
@@ -850,12 +1519,15 @@ async def delete_file(
                         detail=[{"loc": ["path", "path"], "msg": "Unknown type of file"}],
                     )
                 if repo is not None:
-                    commit_and_push(
+                    update_new_folders(branch_id, path.strip("/"))
+                    await run_blocking(
+                        commit_and_push,
                         repo,
                         init_settings.git.remote_name,
                         branch_id,
                         f"Deleted {path}",
                         pygit2.Signature(current_user["name"], current_user["sub"]),
+                        paths=[path],
                     )
             else:
                 raise HTTPException(404)
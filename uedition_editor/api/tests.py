@@ -10,6 +10,8 @@ from shutil import copytree, rmtree
 from fastapi import APIRouter
 from fastapi.exceptions import HTTPException
 
+from uedition_editor.state import file_tree_cache, git_file_tree_cache, remote_fetches, remote_heads, repositories
+
 logger = logging.getLogger(__name__)
 router = APIRouter(prefix="/tests")
 
@@ -28,6 +30,11 @@ def activate_fixture(fixture: str) -> None:
         if os.path.exists("tmp_fixtures"):
             rmtree("tmp_fixtures")
         copytree(source_path, "tmp_fixtures")
+        repositories.invalidate()
+        remote_fetches.clear()
+        remote_heads.clear()
+        file_tree_cache.clear()
+        git_file_tree_cache.clear()
     else:
         raise HTTPException(404)
 
@@ -37,3 +44,8 @@ def deactivate_fixtures() -> None:
     """Reset the uEdition test fixture to use."""
     if os.path.exists("tmp_fixtures"):
         rmtree("tmp_fixtures")
+    repositories.invalidate()
+    remote_fetches.clear()
+    remote_heads.clear()
+    file_tree_cache.clear()
+    git_file_tree_cache.clear()
@@ -1,23 +1,38 @@
 """Utility functionality for the API."""
 
 import logging
-from asyncio import Lock
+import os
+import shutil
+import subprocess
+from asyncio import AbstractEventLoop, CancelledError, Condition, Event, Lock, Task, get_running_loop, wait_for
+from collections.abc import AsyncIterator, Iterator
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from functools import partial
+from threading import Lock as ThreadLock
+from time import monotonic, time
+from typing import Any, Callable
 
 from pygit2 import (
     Commit,
     CredentialType,
     GitError,
     KeypairFromAgent,
+    OdbBackendLoose,
+    Oid,
     RemoteCallbacks,
     Repository,
     Signature,
 )
-from pygit2.enums import FetchPrune, MergeAnalysis, RepositoryOpenFlag
+from pygit2.enums import FetchPrune, MergeAnalysis, ResetMode
 
 from uedition_editor.settings import init_settings
+from uedition_editor.state import remote_fetches, remote_heads, repositories
 
 logger = logging.getLogger(__name__)
-uedition_lock = Lock()
+ARCHIVE_REF_PREFIX = "refs/ueditor-archive/"
+remote_lock = Lock()
+worker_pool: ThreadPoolExecutor | None = None
 
 
 class BranchNotFoundError(BaseException):
@@ -26,37 +41,243 @@ class BranchNotFoundError(BaseException):
     pass
 
 
+class PushRejectedError(Exception):
+    """Error indicating that the remote rejected a push, because the branch has diverged."""
+
+    pass
+
+
+async def run_blocking(func: Callable, *args: Any, **kwargs: Any) -> Any:
+    """
+    Run the blocking `func` in the worker thread pool.
+
+    Use this for any git or XML processing, so that the event loop remains responsive while it runs.
+    """
+    global worker_pool  # noqa: PLW0603
+    if worker_pool is None:
+        worker_pool = ThreadPoolExecutor(max_workers=init_settings.worker_threads, thread_name_prefix="ueditor-worker")
+    return await get_running_loop().run_in_executor(worker_pool, partial(func, *args, **kwargs))
+
+
+class ReadWriteLock:
+    """
+    An asyncio lock that can be held by any number of readers or by a single writer.
+
+    Waiting writers take precedence over new readers, so that a steady stream of readers cannot starve a writer.
+    """
+
+    def __init__(self):
+        """Initialise the unlocked lock."""
+        self._condition = Condition()
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[None]:
+        """Hold the lock for reading."""
+        async with self._condition:
+            await self._condition.wait_for(lambda: not self._writer and self._waiting_writers == 0)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._readers -= 1
+                self._condition.notify_all()
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[None]:
+        """Hold the lock for writing."""
+        async with self._condition:
+            self._waiting_writers += 1
+            try:
+                await self._condition.wait_for(lambda: not self._writer and self._readers == 0)
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            async with self._condition:
+                self._writer = False
+                self._condition.notify_all()
+
+
+class LockManager:
+    """
+    Manager for the locks that guard the git repository.
+
+    Each branch has a `ReadWriteLock` that guards its working tree. The `repository` lock is only needed for operations
+    that change the shared refs (creating, merging, deleting, and synchronising branches). When both are needed, the
+    `repository` lock must be acquired first and branch locks acquired afterwards, with the default branch last.
+    """
+
+    def __init__(self):
+        """Initialise the locks."""
+        self.repository = Lock()
+        self._branches: dict[str, ReadWriteLock] = {}
+
+    def branch(self, branch_id: str) -> ReadWriteLock:
+        """Return the lock that guards the working tree of the `branch_id`."""
+        if branch_id not in self._branches:
+            self._branches[branch_id] = ReadWriteLock()
+        return self._branches[branch_id]
+
+
+locks = LockManager()
+
+
+def worktree_name(branch_id: str) -> str:
+    """Return the name of the worktree used for the `branch_id`."""
+    return branch_id.replace("/", "%2F")
+
+
+def worktree_path(repo: Repository, branch_id: str) -> str:
+    """Return the path of the worktree used for the `branch_id`."""
+    if init_settings.git.worktrees_path is not None:
+        return os.path.abspath(os.path.join(init_settings.git.worktrees_path, worktree_name(branch_id)))
+    return os.path.join(repo.path, "ueditor-worktrees", worktree_name(branch_id))
+
+
+def branch_repository(repo: Repository, branch_id: str) -> Repository:
+    """
+    Return the repository that has the `branch_id` checked out.
+
+    The default branch is always checked out in the main working tree. All other branches are checked out into their
+    own worktree, which is created the first time the branch is accessed. Worktree repositories are lent from the
+    `repositories` pool and have to be returned using `release_branch_repository`.
+    """
+    if branch_id == init_settings.git.default_branch:
+        return repo
+    name = worktree_name(branch_id)
+    if name in repo.list_worktrees():
+        worktree = repo.lookup_worktree(name)
+        if not worktree.is_prunable:
+            return repositories.acquire(worktree.path)
+        worktree.prune(True)
+    path = worktree_path(repo, branch_id)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    logger.debug(f"Creating worktree for {branch_id}")
+    worktree = repo.add_worktree(name, path, repo.branches.local[branch_id])
+    return repositories.acquire(worktree.path)
+
+
+def release_branch_repository(repo: Repository, branch_repo: Repository) -> None:
+    """Return the `branch_repo` obtained from `branch_repository` for the `repo`."""
+    if branch_repo is not repo:
+        repositories.release(branch_repo)
+
+
+def update_branch(repo: Repository, branch_id: str, commit: Oid) -> None:
+    """Point the `branch_id` at the `commit`, updating its working tree only if the branch is checked out."""
+    branch = repo.branches.local[branch_id]
+    branch.set_target(commit)
+    if branch.is_checked_out():
+        branch_repo = branch_repository(repo, branch_id)
+        try:
+            branch_repo.reset(commit, ResetMode.HARD)
+        finally:
+            release_branch_repository(repo, branch_repo)
+
+
+def remove_branch_worktree(repo: Repository, branch_id: str) -> None:
+    """Remove the worktree of the `branch_id`, if it has one."""
+    name = worktree_name(branch_id)
+    if name in repo.list_worktrees():
+        worktree = repo.lookup_worktree(name)
+        if os.path.exists(worktree.path):
+            shutil.rmtree(worktree.path)
+        worktree.prune(True)
+        repositories.invalidate()
+
+
+@contextmanager
+def branch_commit(branch_id: str) -> Iterator[Commit | None]:
+    """
+    Provide the latest commit of the `branch_id` or None if there is no git repository.
+
+    This does not acquire any lock and should only be used to read data from the branch. The commit must not be used
+    after the context has been left.
+    """
+    try:
+        repo = repositories.acquire(init_settings.base_path)
+    except GitError:
+        yield None
+        return
+    try:
+        branch = repo.lookup_branch(branch_id)
+        if branch is None:
+            raise BranchNotFoundError
+        yield branch.peel(Commit)
+    finally:
+        repositories.release(repo)
+
+
+def branch_path(repo: Repository | None) -> str:
+    """Return the path of the working tree of the `repo` or the base path if there is no git repository."""
+    if repo is not None:
+        return repo.workdir
+    return init_settings.base_path
+
+
 class BranchContextManager:
-    """An async ContextManager that checks out the appropriate branch."""
+    """
+    An async ContextManager that provides the working tree of the appropriate branch.
 
-    def __init__(self, branch_id: str):
+    The branch lock is held for writing, unless `write` is False, in which case concurrent readers are allowed.
+    """
+
+    def __init__(self, branch_id: str, write: bool = True):  # noqa: FBT001, FBT002
         """Initialise the context manager."""
         self._branch_id = branch_id
-        try:
-            self._repo = Repository(init_settings.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
-        except GitError:
-            self._repo = None
+        lock = locks.branch(branch_id)
+        self._lock = lock.write() if write else lock.read()
+        self._repo = None
+        self._branch_repo = None
 
     async def __aenter__(self) -> Repository | None:
-        """Enter the context manager, acquiring the lock and checking out the correct branch."""
-        await uedition_lock.acquire()
-        if self._repo:
-            branch = self._repo.lookup_branch(self._branch_id)
-            if branch is not None:
-                self._repo.checkout(branch)
-            else:
-                uedition_lock.release()
+        """Enter the context manager, acquiring the branch lock and returning the branch's repository."""
+        await self._lock.__aenter__()
+        try:
+            self._repo = repositories.acquire(init_settings.base_path)
+        except GitError:
+            return None
+        try:
+            if self._repo.lookup_branch(self._branch_id) is None:
                 raise BranchNotFoundError
-        return self._repo
+            self._branch_repo = await run_blocking(branch_repository, self._repo, self._branch_id)
+            return self._branch_repo
+        except BaseException:
+            await self.__aexit__(None, None, None)
+            raise
 
     async def __aexit__(self, exc_type, exc, tb):
-        """Exit the context manager, releasing the lock."""
-        uedition_lock.release()
+        """Exit the context manager, returning the repositories and releasing the branch lock."""
+        if self._repo is not None:
+            if self._branch_repo is not None:
+                await run_blocking(release_branch_repository, self._repo, self._branch_repo)
+            repositories.release(self._repo)
+            self._repo = None
+            self._branch_repo = None
+        await self._lock.__aexit__(exc_type, exc, tb)
 
 
 class RemoteRepositoryCallbacks(RemoteCallbacks):
     """Callback handler for connecting to remote repositories."""
 
+    def __init__(self):
+        """Initialise the callbacks without any rejected refs."""
+        super().__init__()
+        self.rejected_refs: dict[str, str] = {}
+
+    def push_update_reference(self, refname: str, message: str | None) -> None:
+        """Record the refs that the remote rejected when pushing."""
+        if message is not None:
+            self.rejected_refs[refname] = message
+
     def credentials(
         self,
         url: str,  # noqa: ARG002
@@ -71,29 +292,446 @@ class RemoteRepositoryCallbacks(RemoteCallbacks):
 
 
 def fetch_repo(repo: Repository, remote: str) -> None:
-    """Fetch the remote repository."""
-    repo.remotes[remote].fetch(prune=FetchPrune.PRUNE, callbacks=RemoteRepositoryCallbacks())
+    """Fetch the remote repository, using the configured `git.fetch_mode`."""
+    if init_settings.git.fetch_mode == "tracked":
+        fetch_tracked(repo, remote)
+    elif init_settings.git.fetch_refspecs:
+        repo.remotes[remote].fetch(
+            init_settings.git.fetch_refspecs, prune=FetchPrune.PRUNE, callbacks=RemoteRepositoryCallbacks()
+        )
+    else:
+        repo.remotes[remote].fetch(prune=FetchPrune.PRUNE, callbacks=RemoteRepositoryCallbacks())
+
+
+def tracked_branch_names(repo: Repository, remote: str) -> set[str]:
+    """Return the names of the `remote`'s branches that are the default branch or the upstream of a local branch."""
+    names = {init_settings.git.default_branch}
+    for branch_name in repo.branches.local:
+        upstream = repo.branches.local[branch_name].upstream
+        if upstream is not None and upstream.remote_name == remote:
+            names.add(upstream.branch_name.removeprefix(f"{remote}/"))
+    return names
+
+
+def fetch_tracked(repo: Repository, remote: str) -> None:
+    """
+    Fetch only the default branch and the upstreams of the local branches from the `remote`.
+
+    The remote's branches are listed first, which records them in `remote_heads`. Only those tracked branches that have
+    changed are then fetched, and remote-tracking branches that no longer exist on the remote are removed.
+    """
+    heads = {
+        head.name.removeprefix("refs/heads/"): head.oid
+        for head in repo.remotes[remote].list_heads(callbacks=RemoteRepositoryCallbacks())
+        if head.name.startswith("refs/heads/")
+    }
+    remote_heads[remote] = sorted(heads)
+    prefix = f"refs/remotes/{remote}/"
+    refs = []
+    for name in tracked_branch_names(repo, remote):
+        if name in heads:
+            tracking_ref = repo.references.get(f"{prefix}{name}")
+            if tracking_ref is None or tracking_ref.target != heads[name]:
+                refs.append(f"refs/heads/{name}")
+    if refs:
+        logger.debug(f"Fetching {', '.join(refs)} from {remote}")
+        fetch_refs(repo, remote, refs)
+    for ref in list(repo.references):
+        if ref.startswith(prefix) and ref != f"{prefix}HEAD" and ref.removeprefix(prefix) not in heads:
+            repo.references.delete(ref)
+
+
+def update_remote_heads(remote: str, added: list[str], removed: list[str]) -> None:
+    """Add the `added` and remove the `removed` branch names from the recorded `remote_heads` of the `remote`."""
+    if remote in remote_heads:
+        remote_heads[remote] = sorted((set(remote_heads[remote]) | set(added)) - set(removed))
+
+
+def remote_branch_names(repo: Repository) -> list[str]:
+    """
+    Return the names of the branches of the configured remote, prefixed with the remote's name.
+
+    If only the tracked branches are fetched, then this includes the branches that have not been fetched.
+    """
+    remote = init_settings.git.remote_name
+    if init_settings.git.fetch_mode == "tracked" and remote in remote_heads:
+        return [f"{remote}/{name}" for name in remote_heads[remote]]
+    return [
+        branch_name
+        for branch_name in repo.branches.remote
+        if repo.branches.remote[branch_name].remote_name == remote and "HEAD" not in branch_name
+    ]
 
 
 def pull_branch(repo: Repository, branch: str) -> None:
-    """Pull and update the branch from the remote repository."""
+    """
+    Fast-forward the `branch` to its upstream branch.
+
+    If the `branch` is checked out in the main working tree or a worktree, then that working tree is updated.
+    Otherwise only the branch reference is moved.
+    """
     try:
-        remote_default_head = repo.lookup_reference(repo.branches[branch].upstream_name)
-        result, _ = repo.merge_analysis(remote_default_head.target)
+        local_head = repo.branches.local[branch]
+        remote_head = repo.lookup_reference(local_head.upstream_name)
+        if remote_head.target == local_head.target:
+            return
+        result, _ = repo.merge_analysis(remote_head.target, local_head.name)
         if result & MergeAnalysis.FASTFORWARD == MergeAnalysis.FASTFORWARD:
-            repo.checkout_tree(repo.get(remote_default_head.target))
-            local_default_head = repo.lookup_reference(f"refs/heads/{branch}")
-            local_default_head.set_target(remote_default_head.target)
-            repo.head.set_target(remote_default_head.target)
+            if local_head.is_checked_out():
+                branch_repo = branch_repository(repo, branch)
+                try:
+                    branch_repo.checkout_tree(repo.get(remote_head.target))
+                finally:
+                    release_branch_repository(repo, branch_repo)
+            local_head.set_target(remote_head.target)
     except KeyError as e:
         logger.error(e)
 
 
-def fetch_and_pull_branch(repo: Repository, remote: str, branch: str) -> None:
-    """Fetch and pull the `branch` from the `remote` repository."""
-    repo.checkout(repo.branches[branch])
-    fetch_repo(repo, remote)
-    pull_branch(repo, branch)
+def remote_refs(repo: Repository, remote: str) -> dict[str, str]:
+    """Return the targets of the remote-tracking refs of the `remote`."""
+    prefix = f"refs/remotes/{remote}/"
+    return {name: str(repo.references[name].target) for name in repo.references if name.startswith(prefix)}
+
+
+async def fetch_remote(repo: Repository, max_age: float = 0) -> bool:
+    """
+    Fetch the configured remote into the remote-tracking branches, if the remote exists.
+
+    Only the remote_lock is held while fetching, so that editing is not blocked by the network access. The local
+    branches are not updated. If the last successful fetch happened less than `max_age` seconds ago, then the fetch is
+    skipped. Returns whether the remote-tracking refs have changed.
+    """
+    remote = init_settings.git.remote_name
+    if remote not in list(repo.remotes.names()):
+        return False
+    async with remote_lock:
+        last_fetch = remote_fetches.get(remote)
+        if last_fetch is not None and monotonic() - last_fetch[0] < max_age:
+            logger.debug(f"Skipping fetch of {remote}")
+            return False
+        await run_blocking(fetch_repo, repo, remote)
+        refs = remote_refs(repo, remote)
+        remote_fetches[remote] = (monotonic(), refs)
+        return last_fetch is None or last_fetch[1] != refs
+
+
+def fetch_refs(repo: Repository, remote: str, refs: list[str]) -> None:
+    """Fetch only the branch `refs` from the remote repository into their remote-tracking branches."""
+    refspecs = [f"+{ref}:refs/remotes/{remote}/{ref.removeprefix('refs/heads/')}" for ref in refs]
+    repo.remotes[remote].fetch(refspecs, callbacks=RemoteRepositoryCallbacks())
+
+
+async def fetch_remote_refs(repo: Repository, refs: list[str], deleted_refs: list[str] | None = None) -> None:
+    """
+    Fetch the branch `refs` of the configured remote, if the remote exists, and remove the `deleted_refs`.
+
+    Unlike `fetch_remote`, this only transfers the given refs, so the time of the last fetch is not updated. The
+    `remote_heads` listed by the last fetch are updated with the fetched and removed refs.
+    """
+    remote = init_settings.git.remote_name
+    if remote not in list(repo.remotes.names()):
+        return
+    async with remote_lock:
+        if refs:
+            await run_blocking(fetch_refs, repo, remote, refs)
+        for ref in deleted_refs or []:
+            tracking_ref = f"refs/remotes/{remote}/{ref.removeprefix('refs/heads/')}"
+            if tracking_ref in repo.references:
+                repo.references.delete(tracking_ref)
+        update_remote_heads(
+            remote,
+            [ref.removeprefix("refs/heads/") for ref in refs],
+            [ref.removeprefix("refs/heads/") for ref in deleted_refs or []],
+        )
+
+
+def push_branch(branch: str) -> None:
+    """Push the latest commit of the `branch` to the remote, if both exist."""
+    with repositories.repository(init_settings.base_path) as repo:
+        if init_settings.git.remote_name in repo.remotes.names() and branch in repo.branches.local:
+            remote = repo.remotes[init_settings.git.remote_name]
+            logger.debug(f"Pushing {branch} to {remote.name}")
+            callbacks = RemoteRepositoryCallbacks()
+            try:
+                remote.push([f"refs/heads/{branch}"], callbacks=callbacks)
+            except GitError as ge:
+                if "non-fastforwardable" in str(ge) or "not present locally" in str(ge):
+                    raise PushRejectedError(str(ge)) from ge
+                raise
+            if callbacks.rejected_refs:
+                raise PushRejectedError("; ".join(callbacks.rejected_refs.values()))
+
+
+def reconcile_branch(repo: Repository, branch: str) -> bool:
+    """
+    Merge the remote-tracking branch into the `branch` after a rejected push.
+
+    Returns whether the `branch` has been updated with the remote changes, so that it can be pushed again. This is not
+    the case if the merge has conflicts or if the `branch` already contains the remote changes, in which case the push
+    was rejected for another reason.
+    """
+    remote_name = f"{init_settings.git.remote_name}/{branch}"
+    if remote_name not in repo.branches.remote:
+        return False
+    branch_head = repo.branches.local[branch].peel(Commit)
+    remote_head = repo.branches.remote[remote_name].peel(Commit)
+    if branch_head.id == remote_head.id or repo.descendant_of(branch_head.id, remote_head.id):
+        return False
+    if repo.descendant_of(remote_head.id, branch_head.id):
+        update_branch(repo, branch, remote_head.id)
+        return True
+    index = repo.merge_commits(branch_head, remote_head)
+    if index.conflicts is not None:
+        return False
+    logger.debug(f"Merging {remote_name} into {branch}")
+    author = Signature(branch_head.author.name, branch_head.author.email)
+    update_branch(
+        repo,
+        branch,
+        repo.create_commit(
+            None, author, author, f"Merged {remote_name}", index.write_tree(repo), [branch_head.id, remote_head.id]
+        ),
+    )
+    return True
+
+
+class PushQueue:
+    """
+    Queue of branches with local commits that still need to be pushed to the remote.
+
+    Branches are queued by `commit_and_push` and pushed by a background task, which pushes the latest commit of each
+    branch, so that multiple queued commits result in a single push. Failed pushes are retried with an exponential
+    backoff. If the remote rejects a push, because the branch has diverged, then the remote branch is merged into the
+    branch and the push is retried immediately. If that is not possible, then the branch is marked as rejected and is
+    not pushed again, until it is queued again. Branches can be queued from any thread.
+    """
+
+    def __init__(self):
+        """Initialise the empty queue."""
+        self._pending: dict[str, float] = {}
+        self._failures: dict[str, int] = {}
+        self._rejected: set[str] = set()
+        self._lock = ThreadLock()
+        self._loop: AbstractEventLoop | None = None
+        self._wakeup: Event | None = None
+        self._task: Task | None = None
+
+    @property
+    def running(self) -> bool:
+        """Whether the background task is running."""
+        return self._task is not None
+
+    def is_pending(self, branch: str) -> bool:
+        """Whether the `branch` has commits that still need to be pushed."""
+        with self._lock:
+            return branch in self._pending
+
+    def is_rejected(self, branch: str) -> bool:
+        """Whether the last push of the `branch` was rejected and could not be reconciled."""
+        with self._lock:
+            return branch in self._rejected
+
+    def enqueue(self, branch: str, delay: float = 0) -> None:
+        """Queue the `branch` to be pushed after `delay` seconds."""
+        with self._lock:
+            self._pending[branch] = monotonic() + delay
+            self._rejected.discard(branch)
+        if self._loop is not None and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def update_pending(self, branch: str, update: Callable[[], Any]) -> bool:
+        """
+        Run the `update` if the `branch` is pending.
+
+        While the `update` runs, the `branch` cannot be pushed. Returns whether the `update` was run.
+        """
+        with self._lock:
+            if branch not in self._pending:
+                return False
+            update()
+            return True
+
+    def discard(self, branch: str) -> None:
+        """Remove the `branch` from the queue."""
+        with self._lock:
+            self._pending.pop(branch, None)
+            self._failures.pop(branch, None)
+            self._rejected.discard(branch)
+
+    def start(self) -> None:
+        """Start the background task."""
+        self._loop = get_running_loop()
+        self._wakeup = Event()
+        self._task = self._loop.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the background task and try once to push all branches that are still pending."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except CancelledError:
+                pass
+            self._task = None
+            self._loop = None
+            self._wakeup = None
+        with self._lock:
+            branches = list(self._pending)
+        for branch in branches:
+            await self._push(branch, retry=False)
+
+    async def _run(self) -> None:
+        """Push the queued branches when they are due."""
+        while True:
+            now = monotonic()
+            with self._lock:
+                due = [branch for branch, not_before in self._pending.items() if not_before <= now]
+                next_due = min([not_before for not_before in self._pending.values() if not_before > now], default=None)
+            for branch in due:
+                await self._push(branch)
+            if not due:
+                self._wakeup.clear()
+                try:
+                    await wait_for(self._wakeup.wait(), None if next_due is None else next_due - now)
+                except TimeoutError:
+                    pass
+
+    async def _push(self, branch: str, retry: bool = True) -> None:  # noqa: FBT001, FBT002
+        """Push the `branch`, queueing it again with a backoff if the push fails."""
+        with self._lock:
+            self._pending.pop(branch, None)
+        try:
+            try:
+                async with remote_lock:
+                    await run_blocking(push_branch, branch)
+            except PushRejectedError as pre:
+                logger.warning(f"Push of {branch} was rejected: {pre}")
+                if not retry or not await self._reconcile(branch):
+                    raise
+                with self._lock:
+                    self._pending.setdefault(branch, monotonic())
+                return
+            with self._lock:
+                self._failures.pop(branch, None)
+        except PushRejectedError:
+            logger.error(f"Push of {branch} was rejected and the remote changes could not be merged")
+            with self._lock:
+                self._failures.pop(branch, None)
+                self._rejected.add(branch)
+        except Exception as err:
+            logger.error(err)
+            if retry:
+                with self._lock:
+                    failures = self._failures.get(branch, 0) + 1
+                    self._failures[branch] = failures
+                delay = min(
+                    init_settings.git.push_retry_delay * 2 ** (failures - 1),
+                    init_settings.git.push_retry_max_delay,
+                )
+                logger.debug(f"Retrying to push {branch} in {delay} seconds")
+                with self._lock:
+                    if branch not in self._pending:
+                        self._pending[branch] = monotonic() + delay
+
+    async def _reconcile(self, branch: str) -> bool:
+        """Fetch the remote `branch` and merge it into the local `branch`, returning whether it can be pushed again."""
+        async with locks.repository, locks.branch(branch).write():
+            with repositories.repository(init_settings.base_path) as repo:
+                await fetch_remote_refs(repo, [f"refs/heads/{branch}"])
+                return await run_blocking(reconcile_branch, repo, branch)
+
+
+push_queue = PushQueue()
+
+
+def stage_paths(repo: Repository, paths: list[str]) -> None:
+    """
+    Stage the changes to the given `paths` in the index of the `repo`.
+
+    Each path may be a file or a folder, relative to the working tree. Existing files are added unless they are ignored
+    and not yet tracked, the files in existing folders are added unless they are ignored, and paths that no longer
+    exist are removed from the index, including everything below them.
+    """
+    index = repo.index
+    index.read(False)
+    for path in paths:
+        path = path.strip("/")  # noqa: PLW2901
+        full_path = os.path.join(repo.workdir, *path.split("/"))
+        if os.path.isfile(full_path):
+            if path in index or not repo.path_is_ignored(path):
+                index.add(path)
+        else:
+            if path in index:
+                index.remove(path)
+            index.remove_directory(path)
+            if os.path.isdir(full_path):
+                for dirpath, _, filenames in os.walk(full_path):
+                    for filename in filenames:
+                        file_path = os.path.relpath(os.path.join(dirpath, filename), repo.workdir).replace(os.sep, "/")
+                        if not repo.path_is_ignored(file_path):
+                            index.add(file_path)
+
+
+def schedule_push(repo: Repository, remote: str, branch: str, delay: float = 0) -> None:
+    """
+    Push the `branch` to the `remote`, if the `remote` exists.
+
+    The push is queued in the `push_queue` to happen after `delay` seconds. If the queue is not running, then the push
+    happens immediately.
+    """
+    if remote in repo.remotes.names():
+        if push_queue.running:
+            logger.debug(f"Queueing push of {branch} to {remote}")
+            push_queue.enqueue(branch, delay=delay)
+        else:
+            logger.debug(f"Pushing {branch} to {remote}")
+            repo.remotes[remote].push([f"refs/heads/{branch}"], callbacks=RemoteRepositoryCallbacks())
+
+
+def amend_commit(
+    repo: Repository, remote: str, branch: str, commit_msg: str, author: Signature, tree: Oid
+) -> Oid | None:
+    """
+    Amend the `tree` to the current commit of the `branch`, if it is within the `git.commit_window`.
+
+    The current commit must have been authored by the same `author` within the window, must not be a merge commit or
+    the commit that the `branch` was created at, and must not yet have been pushed. If the `remote` does not exist, then
+    no commit is ever pushed. Returns the amended commit or None, if the current commit could not be amended.
+    """
+    if init_settings.git.commit_window <= 0:
+        return None
+    head = repo.head.peel(Commit)
+    if (
+        len(head.parents) != 1
+        or head.author.email != author.email
+        or time() - head.author.time >= init_settings.git.commit_window
+    ):
+        return None
+    reflog = list(repo.branches.local[branch].log())
+    if reflog and reflog[-1].oid_new == head.id:
+        return None
+    message = head.message.rstrip("\n")
+    if commit_msg not in message.split("\n"):
+        message = f"{message}\n{commit_msg}"
+    new_commit = repo.create_commit(
+        None,
+        Signature(author.name, author.email, head.author.time, head.author.offset),
+        author,
+        message,
+        tree,
+        head.parent_ids,
+    )
+
+    def update_branch():
+        repo.references[repo.head.name].set_target(new_commit, "commit (amend): combined saves")
+
+    if remote not in repo.remotes.names():
+        update_branch()
+    elif not push_queue.update_pending(branch, update_branch):
+        return None
+    logger.debug(f"Amended changes to {branch}")
+    return new_commit
 
 
 def commit_and_push(
@@ -102,27 +740,137 @@ def commit_and_push(
     branch: str,
     commit_msg: str,
     author: Signature,
-    extra_parents: list[str] | None = None,
+    paths: list[str],
 ) -> None | Commit:
-    """Commit changes to the repository and push."""
-    if len(repo.status()) > 0:
-        logger.debug(f"Committing changes to {', '.join(repo.status().keys())}")
-        ref = repo.head.name
-        parents = [repo.head.target]
-        if extra_parents is not None:
-            parents.extend(extra_parents)
-        index = repo.index
-        index.add_all()
+    """
+    Commit changes to the repository and push.
+
+    Only the changes to the given `paths` are staged (see `stage_paths`). A commit is only created if the resulting tree
+    differs from the current one.
+
+    The push is queued in the `push_queue`. If the queue is not running, then the push happens immediately.
+
+    If the `git.commit_window` is set, then the changes are amended to the current commit, if that was created by the
+    same author within the window and has not yet been pushed (see `amend_commit`). The push of a new commit is delayed
+    by the window.
+
+    The index is re-read first, as another handle for the same working tree may have updated it.
+    """
+    index = repo.index
+    index.read(False)
+    stage_paths(repo, paths)
+    tree = index.write_tree()
+    if tree != repo.head.peel(Commit).tree_id:
         index.write()
-        tree = index.write_tree()
-        new_commit = repo.create_commit(ref, author, author, commit_msg, tree, parents)
-        if remote in repo.remotes.names():
-            logger.debug(f"Pushing changes to {remote}")
-            repo.remotes[remote].push([f"refs/heads/{branch}"], callbacks=RemoteRepositoryCallbacks())
+        amended_commit = amend_commit(repo, remote, branch, commit_msg, author, tree)
+        if amended_commit is not None:
+            return amended_commit
+        logger.debug(f"Committing changes to {', '.join(paths)}")
+        new_commit = repo.create_commit(repo.head.name, author, author, commit_msg, tree, [repo.head.target])
+        schedule_push(repo, remote, branch, delay=init_settings.git.commit_window)
         return new_commit
     return None
 
 
+def pack_loose_objects(repo: Repository) -> int:
+    """Move the loose objects of the `repo` into a new pack and return the number of objects packed."""
+    objects_path = os.path.join(repo.path, "objects")
+    oids = list(OdbBackendLoose(objects_path, 0, False))
+    if oids:
+
+        def add_loose_objects(pack_builder):
+            for oid in oids:
+                pack_builder.add(oid)
+
+        repo.pack(pack_delegate=add_loose_objects)
+        for oid in oids:
+            os.remove(os.path.join(objects_path, str(oid)[:2], str(oid)[2:]))
+    return len(oids)
+
+
+def maintain_repository(repo: Repository) -> None:
+    """
+    Optimise the object and reference storage of the `repo`.
+
+    If git is installed, then it is used to repack the objects, prune unreachable objects, pack the references, and
+    write a commit-graph. Otherwise the loose objects and references are packed using pygit2, which can neither prune
+    nor write commit-graphs.
+    """
+    git = shutil.which("git")
+    if git is not None:
+        for args in (["gc", "--quiet"], ["commit-graph", "write", "--reachable"]):
+            logger.debug(f"Running git {' '.join(args)}")
+            subprocess.run([git, "--git-dir", repo.path, *args], check=True, capture_output=True)  # noqa: S603
+    else:
+        logger.debug(f"Packed {pack_loose_objects(repo)} loose objects")
+        repo.compress_references()
+
+
+def archivable_branches(repo: Repository) -> list[str]:
+    """
+    Return the branches that the configured archival policy applies to.
+
+    A branch is merged if it has commits of its own and these are contained in the default branch. It is stale if its
+    last activity is older than `git.archive_after_days`. Both are determined from the branch's reflog, falling back to
+    its last commit if there is no reflog. The default branch and branches with pending pushes are never archived.
+    """
+    if not init_settings.git.archive_merged and init_settings.git.archive_after_days is None:
+        return []
+    default_branch_head = repo.branches.local[init_settings.git.default_branch].peel(Commit)
+    branches = []
+    for branch_name in repo.branches.local:
+        if branch_name == init_settings.git.default_branch or push_queue.is_pending(branch_name):
+            continue
+        branch = repo.branches.local[branch_name]
+        branch_head = branch.peel(Commit)
+        reflog = list(branch.log())
+        if reflog:
+            last_activity = reflog[0].committer.time
+            has_own_commits = reflog[-1].oid_new != branch_head.id
+        else:
+            last_activity = branch_head.commit_time
+            has_own_commits = repo.merge_base(default_branch_head.id, branch_head.id) != branch_head.id
+        if (
+            init_settings.git.archive_after_days is not None
+            and time() - last_activity > init_settings.git.archive_after_days * 86400
+        ):
+            branches.append(branch_name)
+        elif init_settings.git.archive_merged and has_own_commits and branch_head.id != default_branch_head.id:
+            if repo.descendant_of(default_branch_head.id, branch_head.id):
+                branches.append(branch_name)
+            else:
+                index = repo.merge_commits(default_branch_head, branch_head)
+                if index.conflicts is None and index.write_tree(repo) == default_branch_head.tree_id:
+                    branches.append(branch_name)
+    return branches
+
+
+def archive_branch(repo: Repository, branch_id: str) -> None:
+    """Move the `branch_id` into the archive and remove its worktree."""
+    logger.debug(f"Archiving {branch_id}")
+    repo.references.create(f"{ARCHIVE_REF_PREFIX}{branch_id}", repo.branches.local[branch_id].target, force=True)
+    remove_branch_worktree(repo, branch_id)
+    repo.branches.delete(branch_id)
+
+
+def restore_branch(repo: Repository, branch_id: str) -> None:
+    """Restore the archived `branch_id`, tracking the remote branch of the same name if that exists."""
+    logger.debug(f"Restoring {branch_id}")
+    reference = repo.references[f"{ARCHIVE_REF_PREFIX}{branch_id}"]
+    branch = repo.branches.local.create(branch_id, repo.get(reference.target))
+    remote_branch = repo.branches.remote.get(f"{init_settings.git.remote_name}/{branch_id}")
+    if remote_branch is not None:
+        branch.upstream = remote_branch
+    reference.delete()
+
+
+def archived_branch_names(repo: Repository) -> list[str]:
+    """Return the names of the archived branches."""
+    return sorted(
+        name.removeprefix(ARCHIVE_REF_PREFIX) for name in repo.references if name.startswith(ARCHIVE_REF_PREFIX)
+    )
+
+
 def slugify(slug: str) -> str:
     """Turn a title into a slug."""
     return slug.lower().replace(" ", "-")
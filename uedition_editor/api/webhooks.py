@@ -0,0 +1,77 @@
+# SPDX-FileCopyrightText: 2024-present Mark Hall <mark.hall@work.room3b.eu>
+#
+# SPDX-License-Identifier: MIT
+"""The uEditor API for receiving notifications about changes to the git remote."""
+
+import hmac
+import json
+import logging
+from hashlib import sha256
+from typing import Annotated
+
+from fastapi import APIRouter, BackgroundTasks, Header, Request
+from fastapi.exceptions import HTTPException
+
+from uedition_editor import cron
+from uedition_editor.settings import init_settings
+
+logger = logging.getLogger(__name__)
+router = APIRouter(prefix="/webhooks")
+
+DELETED_COMMIT = "0" * 40
+
+
+def payload_refs(payload: dict) -> tuple[list[str], list[str]]:
+    """
+    Extract the updated and deleted branch refs from the webhook `payload`.
+
+    Supports the push events sent by GitHub, GitLab, Gitea, and Forgejo, which contain a single "ref", as well as a
+    "refs" list of updated and a "deleted_refs" list of deleted refs.
+    """
+    refs = []
+    deleted_refs = []
+    if isinstance(payload.get("ref"), str):
+        if payload.get("deleted") is True or payload.get("after") == DELETED_COMMIT:
+            deleted_refs.append(payload["ref"])
+        else:
+            refs.append(payload["ref"])
+    if isinstance(payload.get("refs"), list):
+        refs.extend(ref for ref in payload["refs"] if isinstance(ref, str))
+    if isinstance(payload.get("deleted_refs"), list):
+        deleted_refs.extend(ref for ref in payload["deleted_refs"] if isinstance(ref, str))
+    return (
+        [ref for ref in refs if ref.startswith("refs/heads/")],
+        [ref for ref in deleted_refs if ref.startswith("refs/heads/")],
+    )
+
+
+@router.post("/git", status_code=202)
+async def git_webhook(
+    request: Request,
+    background_tasks: BackgroundTasks,
+    x_hub_signature_256: Annotated[str | None, Header()] = None,
+) -> None:
+    """
+    Receive a notification that refs in the git remote have been updated.
+
+    The request body must be signed with the `git.webhook_secret`, using an HMAC-SHA256 that is sent as
+    "sha256=<hexdigest>" in the X-Hub-Signature-256 header. The updated refs are fetched in the background.
+    """
+    if not init_settings.git.webhook_secret:
+        raise HTTPException(404)
+    body = await request.body()
+    signature = "sha256=" + hmac.new(init_settings.git.webhook_secret.encode(), body, sha256).hexdigest()
+    if x_hub_signature_256 is None or not hmac.compare_digest(signature, x_hub_signature_256):
+        raise HTTPException(403)
+    try:
+        payload = json.loads(body)
+    except ValueError as ve:
+        raise HTTPException(422, detail=[{"msg": "the payload is not valid JSON"}]) from ve
+    if not isinstance(payload, dict):
+        raise HTTPException(422, detail=[{"msg": "the payload must be a JSON object"}])
+    refs, deleted_refs = payload_refs(payload)
+    if refs or deleted_refs:
+        background_tasks.add_task(cron.track_refs, refs, deleted_refs)
+    else:
+        logger.debug("Webhook payload without branch refs, synchronising the whole remote")
+        background_tasks.add_task(cron.track_branches)
@@ -4,16 +4,17 @@
 """The uEditor CLI application."""
 
 import re
+from subprocess import CalledProcessError
 from typing import Annotated
 
-from pygit2 import GitError, Repository, Signature, init_repository
+from pygit2 import GitError, Repository, Signature, clone_repository, init_repository
 from pygit2.enums import RepositoryOpenFlag
 from rich import print  # noqa:A004
 from typer import Context, Option, Typer
 from uvicorn import Config, Server
 
 from uedition_editor.__about__ import __version__
-from uedition_editor.api.util import RemoteRepositoryCallbacks
+from uedition_editor.api.util import RemoteRepositoryCallbacks, maintain_repository
 from uedition_editor.settings import init_settings
 
 app = Typer()
@@ -106,3 +107,51 @@ def set_remote(url: Annotated[str, Option(prompt="Git URL")]):
     repo.branches[init_settings.git.default_branch].upstream = repo.branches[
         f"{init_settings.git.remote_name}/{init_settings.git.default_branch}"
     ]
+
+
+@git_app.command()
+def clone(
+    url: Annotated[str, Option(prompt="Git URL")],
+    depth: Annotated[int, Option(help="Number of commits of history to clone. 0 clones the full history.", min=0)] = 0,
+):
+    """Clone the remote repository into the base path."""
+    try:
+        Repository(init_settings.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
+        print("[red]This μEdition already has a git repository set up[/red]")
+        return
+    except GitError:
+        pass
+    try:
+        repo = clone_repository(
+            url,
+            init_settings.base_path,
+            remote=lambda repo, _, url: repo.remotes.create(init_settings.git.remote_name, url),
+            checkout_branch=init_settings.git.default_branch,
+            callbacks=RemoteRepositoryCallbacks(),
+            depth=depth,
+        )
+    except GitError as ge:
+        print(f"[red]The repository could not be cloned: {ge}[/red]")
+        return
+    repo.branches[init_settings.git.default_branch].upstream = repo.branches[
+        f"{init_settings.git.remote_name}/{init_settings.git.default_branch}"
+    ]
+    if repo.is_shallow:
+        print(f"Cloned the latest {depth} commits of {init_settings.git.default_branch}")
+    else:
+        print(f"Cloned {init_settings.git.default_branch}")
+
+
+@git_app.command()
+def maintain():
+    """Optimise the storage of the git repository."""
+    try:
+        repo = Repository(init_settings.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
+    except GitError:
+        print("[red]This μEdition does not have a git repository set up[/red]")
+        return
+    try:
+        maintain_repository(repo)
+        print("Repository maintenance complete")
+    except CalledProcessError as cpe:
+        print(f"[red]The repository maintenance failed: {cpe.stderr.decode()}[/red]")
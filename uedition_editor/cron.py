@@ -4,16 +4,41 @@
 """Regular jobs run in the background of the uEditor."""
 
 import logging
+from asyncio import Task, get_running_loop, shield, sleep
+from datetime import datetime, timedelta
+from subprocess import CalledProcessError
+from time import monotonic
 
-import aiocron
-from pygit2 import GitError, Repository
-from pygit2.enums import RepositoryOpenFlag
+from pygit2 import Commit, GitError, Repository
 
-from uedition_editor.api.util import de_slugify, fetch_repo, pull_branch, uedition_lock
+from uedition_editor.api.util import (
+    archivable_branches,
+    archive_branch,
+    archived_branch_names,
+    de_slugify,
+    fetch_remote,
+    fetch_remote_refs,
+    locks,
+    maintain_repository,
+    pull_branch,
+    remote_branch_names,
+    run_blocking,
+)
 from uedition_editor.settings import init_settings
-from uedition_editor.state import local_branches, remote_branches
+from uedition_editor.state import (
+    archived_branches,
+    branch_status_cache,
+    git_file_tree_cache,
+    local_branches,
+    merge_preview_cache,
+    new_folders,
+    remote_branches,
+    repositories,
+)
 
 logger = logging.getLogger(__name__)
+sync_task: Task | None = None
+last_synchronised: float | None = None
 
 
 def format_remote_branch_title(title: str) -> str:
@@ -23,51 +48,185 @@ def format_remote_branch_title(title: str) -> str:
     return title
 
 
+def branch_status(repo: Repository, branch_name: str) -> dict:
+    """
+    Determine the status of the branch `branch_name` relative to the default branch.
+
+    The status is computed from the commit trees only, without checking out either branch.
+    """
+    default_head = repo.branches.local[init_settings.git.default_branch].peel(Commit)
+    branch_head = repo.branches.local[branch_name].peel(Commit)
+    merge_base = repo.get(repo.merge_base(default_head.id, branch_head.id))
+    diff_to_default = merge_base.tree.diff_to_tree(default_head.tree)
+    diff_to_branch = merge_base.tree.diff_to_tree(branch_head.tree)
+    return {
+        "id": branch_name.replace("/", "%252F"),
+        "title": de_slugify(branch_name),
+        "update_from_default": len(diff_to_default) > 0,
+        "modified_files": [delta.new_file.path for delta in diff_to_branch.deltas],
+    }
+
+
 async def insecure_track_branches():
     """
-    Track the status of all git branches.
+    Fast-forward the local branches and track the status of all git branches.
+
+    This does not fetch from the remote, which has to be done beforehand using `fetch_remote`. Use only when the
+    repository lock is already aquired. The individual branch locks must not be held, as they are acquired while
+    updating each branch.
+    """
+    local = []
+    remote = []
+    archived = []
+    try:
+        with repositories.repository(init_settings.base_path) as repo:
+            logger.debug("Tracking branches")
+            async with locks.branch(init_settings.git.default_branch).write():
+                if repo.head_is_detached or repo.head.shorthand != init_settings.git.default_branch:
+                    await run_blocking(repo.checkout, repo.branches[init_settings.git.default_branch])
+            logger.debug("Updating branch status")
+            has_remote = init_settings.git.remote_name in list(repo.remotes.names())
+            for branch_name in repo.branches.local:
+                branch = repo.branches.local[branch_name]
+                if has_remote and branch.upstream is not None and branch.upstream.target != branch.target:
+                    async with locks.branch(branch_name).write():
+                        await run_blocking(pull_branch, repo, branch_name)
+            default_target = str(repo.branches.local[init_settings.git.default_branch].target)
+            for branch_name in repo.branches.local:
+                key = (str(repo.branches.local[branch_name].target), default_target)
+                if branch_name not in branch_status_cache or branch_status_cache[branch_name][0] != key:
+                    logger.debug(f"Updating status of {branch_name}")
+                    branch_status_cache[branch_name] = (key, await run_blocking(branch_status, repo, branch_name))
+                local.append(branch_status_cache[branch_name][1])
+            for cache in (branch_status_cache, merge_preview_cache, git_file_tree_cache):
+                for branch_name in list(cache):
+                    if branch_name not in repo.branches.local:
+                        del cache[branch_name]
+            for branch_name in remote_branch_names(repo):
+                remote.append({"id": branch_name, "title": format_remote_branch_title(branch_name)})
+            for branch_name in archived_branch_names(repo):
+                archived.append({"id": branch_name.replace("/", "%252F"), "title": de_slugify(branch_name)})
+            logger.debug("Tracking complete")
+    except GitError as ge:
+        logger.error(ge)
+        local = [{"id": "-", "title": "Direct Access", "nogit": True}]
+        remote = []
+        archived = []
+    local_branches[:] = local
+    remote_branches[:] = remote
+    archived_branches[:] = archived
+
+
+async def track_branches() -> bool:
+    """
+    Synchronise with the remote and track the status of all git branches.
 
-    Use only when the uedition_lock is already aquired.
+    The remote is fetched without holding the repository lock, which is then only acquired to update the local branches.
+    Returns whether the remote has changed.
     """
-    remote_branches.clear()
-    local_branches.clear()
+    global last_synchronised  # noqa: PLW0603
+    changed = False
     try:
-        repo = Repository(init_settings.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
-        logger.debug("Tracking branches")
-        repo.checkout(repo.branches[init_settings.git.default_branch])
-        if init_settings.git.remote_name in list(repo.remotes.names()):
+        with repositories.repository(init_settings.base_path) as repo:
             logger.debug("Synchronising with remote")
-            fetch_repo(repo, init_settings.git.remote_name)
-        logger.debug("Updating branch status")
-        for branch_name in repo.branches.local:
-            repo.checkout(repo.branches[branch_name])
-            if init_settings.git.remote_name in list(repo.remotes.names()):
-                if repo.branches[branch_name].upstream is not None:
-                    pull_branch(repo, branch_name)
-            merge_base = repo.merge_base(
-                repo.revparse_single(init_settings.git.default_branch).id, repo.revparse_single(branch_name).id
-            )
-            diff_to_default = repo.diff(merge_base, repo.revparse_single(init_settings.git.default_branch))
-            diff_to_branch = repo.diff(merge_base, repo.revparse_single(branch_name))
-            local_branches.append(
-                {
-                    "id": branch_name.replace("/", "%252F"),
-                    "title": de_slugify(branch_name),
-                    "update_from_default": diff_to_default.stats.files_changed > 0,
-                    "modified_files": [patch.delta.new_file.path for patch in diff_to_branch],
-                }
-            )
-        for branch_name in repo.branches.remote:
-            if repo.branches[branch_name].remote_name == init_settings.git.remote_name and "HEAD" not in branch_name:
-                remote_branches.append({"id": branch_name, "title": format_remote_branch_title(branch_name)})
-        logger.debug("Tracking complete")
+            changed = await fetch_remote(repo)
     except GitError as ge:
         logger.error(ge)
-        local_branches.append({"id": "-", "title": "Direct Access", "nogit": True})
+    async with locks.repository:
+        await insecure_track_branches()
+    last_synchronised = monotonic()
+    return changed
+
 
+async def track_refs(refs: list[str], deleted_refs: list[str]) -> None:
+    """
+    Fetch only the updated `refs`, remove the `deleted_refs`, and track the status of all git branches.
 
-@aiocron.crontab("*/5 * * * *")
-async def track_branches() -> None:
-    """Track the status of all git branches."""
-    async with uedition_lock:
+    If fetching the `refs` fails, then the whole remote is synchronised instead.
+    """
+    try:
+        with repositories.repository(init_settings.base_path) as repo:
+            logger.debug(f"Fetching {', '.join(refs)} from the remote")
+            await fetch_remote_refs(repo, refs, deleted_refs)
+    except GitError as ge:
+        logger.error(ge)
+        await track_branches()
+        return
+    async with locks.repository:
         await insecure_track_branches()
+
+
+async def poll_branches() -> None:
+    """
+    Regularly synchronise with the remote.
+
+    The interval is `git.poll_interval`. If the `git.webhook_secret` is set, so that changes are pushed through the
+    webhook, then the interval doubles up to `git.poll_max_interval` each time the remote has not changed and is reset
+    when the remote changes.
+    """
+    interval = init_settings.git.poll_interval
+    while True:
+        await sleep(interval)
+        if await track_branches() or init_settings.git.webhook_secret is None:
+            interval = init_settings.git.poll_interval
+        else:
+            interval = min(interval * 2, max(init_settings.git.poll_max_interval, init_settings.git.poll_interval))
+        logger.debug(f"Polling the remote again in {interval} seconds")
+
+
+async def synchronise_branches() -> None:
+    """
+    Synchronise with the remote on request.
+
+    Concurrent requests join the synchronisation that is already running. If the last synchronisation completed within
+    the `git.sync_freshness` window, then the current branch state is kept. A new synchronisation discards the pooled
+    repository handles first, so that changes made outside of the uEditor are picked up.
+    """
+    global sync_task  # noqa: PLW0603
+    if sync_task is None or sync_task.done() or sync_task.get_loop() is not get_running_loop():
+        if last_synchronised is not None and monotonic() - last_synchronised < init_settings.git.sync_freshness:
+            return
+        repositories.invalidate()
+        sync_task = get_running_loop().create_task(track_branches())
+    await shield(sync_task)
+
+
+async def archive_branches() -> None:
+    """Archive the branches that the archival policy applies to. Use only when the repository lock is acquired."""
+    with repositories.repository(init_settings.base_path) as repo:
+        for branch_name in await run_blocking(archivable_branches, repo):
+            async with locks.branch(branch_name).write():
+                await run_blocking(archive_branch, repo, branch_name)
+            new_folders.pop(branch_name, None)
+    await insecure_track_branches()
+
+
+async def run_maintenance() -> None:
+    """Archive branches and run the repository maintenance while holding the repository lock."""
+    try:
+        async with locks.repository:
+            await archive_branches()
+            with repositories.repository(init_settings.base_path) as repo:
+                logger.debug("Maintaining the repository")
+                await run_blocking(maintain_repository, repo)
+        repositories.invalidate()
+    except (GitError, CalledProcessError) as e:
+        logger.error(e)
+
+
+async def schedule_maintenance() -> None:
+    """
+    Run the repository maintenance every day at the `git.maintenance_hour`.
+
+    Errors are logged, so that a failed maintenance does not stop the schedule.
+    """
+    while True:
+        now = datetime.now().astimezone()
+        next_run = now.replace(hour=init_settings.git.maintenance_hour, minute=0, second=0, microsecond=0)
+        if next_run <= now:
+            next_run = next_run + timedelta(days=1)
+        await sleep((next_run - now).total_seconds())
+        try:
+            await run_maintenance()
+        except Exception as e:
+            logger.error(e)
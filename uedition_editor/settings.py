@@ -4,22 +4,26 @@
 """Settings for the uEditor."""
 
 import os
+from contextvars import ContextVar
+from functools import lru_cache
 from secrets import token_hex
 from typing import Any, Dict, Literal, Optional, Tuple, Type
 
 import yaml_include
-from pydantic import BaseModel, EmailStr, model_validator
+from fsspec.implementations.git import GitFileSystem
+from pydantic import BaseModel, EmailStr, Field, model_validator
 from pydantic.fields import FieldInfo
 from pydantic_settings import (
     BaseSettings,
     PydanticBaseSettingsSource,
     SettingsConfigDict,
 )
-from pygit2 import GitError, Repository
-from pygit2.enums import RepositoryOpenFlag
+from pygit2 import Commit, GitError
 from typing_extensions import Self
 from uedition.settings import Settings as UEditonSettingsBase
-from yaml import SafeLoader, add_constructor, load
+from yaml import SafeLoader, load
+
+from uedition_editor.state import repositories
 
 
 class NoAuth(BaseModel):
@@ -75,6 +79,41 @@ class GitSettings(BaseModel):
     remote_name: str = "origin"
     default_branch: str = "main"
     protect_default_branch: bool = False
+    worktrees_path: str | None = None
+    """Folder in which the branch worktrees are created. Defaults to a folder within the .git folder."""
+    commit_window: float = Field(default=0, ge=0)
+    """Seconds within which saves by the same user to a branch are combined into a single commit. 0 disables this."""
+    fetch_mode: Literal["all", "tracked"] = "all"
+    """
+    Which refs to fetch from the remote. "all" fetches using the `fetch_refspecs`, or the remote's refspecs if those are
+    not set. "tracked" only fetches the default branch and the upstreams of the local branches and discovers the other
+    remote branches by listing the remote's refs.
+    """
+    fetch_refspecs: list[str] = []
+    """Refspecs to fetch in the "all" `fetch_mode`. Defaults to the refspecs configured for the remote."""
+    fetch_max_age: float = Field(default=0, ge=0)
+    """Seconds after a fetch within which branch operations do not fetch from the remote again."""
+    sync_freshness: float = Field(default=0, ge=0)
+    """Seconds after a synchronisation within which requested synchronisations return the current branch state."""
+    push_retry_delay: float = 5
+    """Seconds to wait before retrying a failed push. Doubles with each further failure."""
+    push_retry_max_delay: float = 300
+    """Maximum number of seconds to wait before retrying a failed push."""
+    poll_interval: float = Field(default=300, ge=0)
+    """Seconds between polls of the remote while it changes. 0 disables polling."""
+    poll_max_interval: float = Field(default=3600, ge=0)
+    """
+    Maximum number of seconds between polls, to which the interval doubles while the remote does not change. Only used
+    if the `webhook_secret` is set.
+    """
+    maintenance_hour: int | None = Field(default=None, ge=0, le=23)
+    """Local hour of the day at which the repository maintenance runs. If not set (the default), there is none."""
+    archive_merged: bool = False
+    """Whether the maintenance archives branches whose changes have been merged into the default branch."""
+    archive_after_days: int | None = Field(default=None, ge=1)
+    """Days without commits after which the maintenance archives a branch. If not set, stale branches are kept."""
+    webhook_secret: str | None = None
+    """Secret used to sign the requests to the git webhook. The webhook is disabled if this is not set."""
 
 
 class InitSettings(BaseSettings):
@@ -84,6 +123,8 @@ class InitSettings(BaseSettings):
     auth: NoAuth | EmailAuth | EmailPasswordAuth | GithubOAuth2 = NoAuth()
     session: SessionSettings = SessionSettings()
     git: GitSettings = GitSettings()
+    worker_threads: int = Field(default=4, ge=1)
+    """Number of threads used to run blocking git and XML processing."""
     test: bool = False
     dev: bool = False
 
@@ -92,10 +133,10 @@ class InitSettings(BaseSettings):
         """Check that there is no git repository for no-auth authentication."""
         if self.auth.provider == "no-auth":
             try:
-                Repository(self.base_path, flags=RepositoryOpenFlag.NO_SEARCH)
-                raise ValueError(
-                    "You need to configure an authentication method when using a git repository."  # noqa: EM101
-                )
+                with repositories.repository(self.base_path):
+                    raise ValueError(
+                        "You need to configure an authentication method when using a git repository."  # noqa: EM101
+                    )
             except GitError:
                 pass
         return self
@@ -110,22 +151,61 @@ class InitSettings(BaseSettings):
 
 
 init_settings = InitSettings()
+config_source: ContextVar[str | Commit | None] = ContextVar("config_source", default=None)
+
+
+@lru_cache
+def yaml_loader(base_path: str) -> Type[SafeLoader]:
+    """Return a YAML loader that resolves !include relative to the `base_path`."""
+
+    class IncludeLoader(SafeLoader):
+        pass
+
+    IncludeLoader.add_constructor("!include", yaml_include.Constructor(base_dir=base_path))
+    return IncludeLoader
+
 
-add_constructor("!include", yaml_include.Constructor(base_dir=init_settings.base_path), SafeLoader)
+@lru_cache(maxsize=16)
+def git_yaml_loader(commit_id: str) -> Type[SafeLoader]:
+    """Return a YAML loader that resolves !include from the files in the commit `commit_id`."""
+
+    class IncludeLoader(SafeLoader):
+        pass
+
+    IncludeLoader.add_constructor(
+        "!include",
+        yaml_include.Constructor(
+            fs=GitFileSystem(path=init_settings.base_path, ref=commit_id, skip_instance_cache=True), base_dir=""
+        ),
+    )
+    return IncludeLoader
 
 
 class YAMLConfigSettingsSource(PydanticBaseSettingsSource):
-    """Loads the configuration settings from a YAML file."""
+    """
+    Loads the configuration settings from a YAML file.
+
+    The file is loaded from the current `config_source`, which is either a base path or a git commit. If no source is
+    set, then the file is loaded from the configured base path.
+    """
 
     def __init__(self, settings_cls: Type[BaseSettings], source_files: list[str]):
         """Initialise and load the data."""
         super().__init__(settings_cls)
         self._file_content = None
         encoding = self.config.get("env_file_encoding")
+        source = config_source.get()
+        if isinstance(source, Commit):
+            for filename in source_files:
+                if filename in source.tree:
+                    self._file_content = load(source.tree[filename].data, git_yaml_loader(str(source.id)))  # noqa: S506
+                    break
+            return
+        base_path = source if source is not None else init_settings.base_path
         for filename in source_files:
-            if os.path.exists(os.path.join(init_settings.base_path, filename)):
-                with open(os.path.join(init_settings.base_path, filename), encoding=encoding) as in_f:
-                    self._file_content = load(in_f, SafeLoader)
+            if os.path.exists(os.path.join(base_path, filename)):
+                with open(os.path.join(base_path, filename), encoding=encoding) as in_f:
+                    self._file_content = load(in_f, yaml_loader(base_path))  # noqa: S506
                     break
 
     def get_field_value(
@@ -466,6 +546,8 @@ class UEditorSettings(BaseSettings):
 
     tei: TEISettings = TEISettings()
     ui: UISettings = UISettings()
+    exclude: list[str] = []
+    """Patterns of the files and folders that are not shown in the tree of files, using the .gitignore syntax."""
 
     @classmethod
     def settings_customise_sources(
@@ -508,11 +590,19 @@ class UEditionSettings(UEditonSettingsBase):
         )
 
 
-def get_ueditor_settings() -> UEditorSettings:
-    """Load the current UEditorSettings."""
-    return UEditorSettings()
+def get_ueditor_settings(source: str | Commit | None = None) -> UEditorSettings:
+    """Load the current UEditorSettings, optionally from the given base path or commit `source`."""
+    token = config_source.set(source)
+    try:
+        return UEditorSettings()
+    finally:
+        config_source.reset(token)
 
 
-def get_uedition_settings() -> UEditionSettings:
-    """Load the current UEditionSettings."""
-    return UEditionSettings()
+def get_uedition_settings(source: str | Commit | None = None) -> UEditionSettings:
+    """Load the current UEditionSettings, optionally from the given base path or commit `source`."""
+    token = config_source.set(source)
+    try:
+        return UEditionSettings()
+    finally:
+        config_source.reset(token)
@@ -3,5 +3,87 @@
 # SPDX-License-Identifier: MIT
 """Shared state for the uEditor."""
 
+import os
+from collections.abc import Iterator
+from contextlib import contextmanager
+from threading import Lock
+
+from pygit2 import Repository
+from pygit2.enums import RepositoryOpenFlag
+
 local_branches = []
 remote_branches = []
+archived_branches = []
+branch_status_cache: dict[str, tuple[tuple[str, str], dict]] = {}
+"""Branch status per branch, keyed by the commit ids of the branch and the default branch it was computed for."""
+merge_preview_cache: dict[str, tuple[tuple[str, str], dict]] = {}
+"""Merge previews per branch, keyed by the commit ids of the branch and the default branch they were computed for."""
+remote_fetches: dict[str, tuple[float, dict[str, str]]] = {}
+"""Monotonic time of the last successful fetch per remote and the remote-tracking refs that it resulted in."""
+remote_heads: dict[str, list[str]] = {}
+"""Names of the branches per remote, as listed when only the tracked branches are fetched."""
+file_tree_cache: dict[str, tuple[dict[str, int], list[dict]]] = {}
+"""File trees per branch read from the filesystem, with the modification times of the folders and settings they were
+built from."""
+git_file_tree_cache: dict[str, tuple[str, list[str], list[dict], dict[tuple[str, str], list[dict]]]] = {}
+"""File trees per branch read from git, with the tree id and exclude patterns they were built from and the folder
+contents per path and tree id."""
+new_folders: dict[str, set[str]] = {}
+"""Folders per branch that have been created, but do not contain any files yet and are thus not tracked by git."""
+
+
+class RepositoryPool:
+    """
+    Process-wide pool of open git repositories.
+
+    A repository must not be used by multiple threads at once, so each handle is lent exclusively using `acquire` or
+    `repository` and is reused once it has been returned, which keeps its object database and pack caches. Use
+    `invalidate` when repositories or worktrees have been changed outside of the pool's handles.
+    """
+
+    def __init__(self):
+        """Initialise the empty pool."""
+        self._idle: dict[str, list[Repository]] = {}
+        self._lent: dict[int, tuple[str, int]] = {}
+        self._generation = 0
+        self._lock = Lock()
+
+    def acquire(self, path: str) -> Repository:
+        """Lend a repository handle for the `path`, which has to be returned using `release`."""
+        path = os.path.abspath(path)
+        with self._lock:
+            generation = self._generation
+            if self._idle.get(path):
+                repo = self._idle[path].pop()
+                self._lent[id(repo)] = (path, generation)
+                return repo
+        repo = Repository(path, flags=RepositoryOpenFlag.NO_SEARCH)
+        with self._lock:
+            self._lent[id(repo)] = (path, generation)
+        return repo
+
+    def release(self, repo: Repository) -> None:
+        """Return the lent `repo` to the pool."""
+        with self._lock:
+            path, generation = self._lent.pop(id(repo), (None, None))
+            if path is not None and generation == self._generation:
+                self._idle.setdefault(path, []).append(repo)
+
+    @contextmanager
+    def repository(self, path: str) -> Iterator[Repository]:
+        """Lend a repository handle for the `path` for the duration of the context."""
+        repo = self.acquire(path)
+        try:
+            yield repo
+        finally:
+            self.release(repo)
+
+    def invalidate(self) -> None:
+        """Close all idle handles and discard all lent handles when they are returned."""
+        with self._lock:
+            self._idle.clear()
+            self._generation += 1
+
+
+repositories = RepositoryPool()
+"""Pool of the repository handles used by the uEditor."""